@@ -0,0 +1,29 @@
+"""
+Cache backend taken from the environment.
+
+CACHE_URL selects the backend: ``redis://host:6379/0``, ``memcached://host:11211`` or ``file:///cache`` (a directory,
+relative paths start in the project directory like DATABASE_URL). Without it every process gets its own local memory
+cache, which is only correct for a single process: the chemical cards, the sharing directory and their version stamps
+live in the cache, so a change made in one worker would not reach the others until the entries time out.
+"""
+from pathlib import Path
+from urllib.parse import unquote, urlsplit
+
+PROCESS_LOCAL_BACKEND = 'django.core.cache.backends.locmem.LocMemCache'
+
+
+def cache_config(url=None, base_dir='.'):
+    """A CACHES entry for url, a process local cache without one"""
+    if not url:
+        return {'BACKEND': PROCESS_LOCAL_BACKEND}
+
+    parts = urlsplit(url)
+    if parts.scheme in ('redis', 'rediss'):
+        return {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': url}
+    if parts.scheme in ('memcached', 'pymemcache'):
+        return {'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache', 'LOCATION': parts.netloc}
+    if parts.scheme == 'file':
+        # file:///cache is relative to base_dir, file:////var/cache/chemdata absolute
+        return {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                'LOCATION': Path(base_dir) / unquote(parts.path)[1:]}
+    raise ValueError(f'Unsupported CACHE_URL scheme "{parts.scheme}", use redis://, memcached:// or file://')
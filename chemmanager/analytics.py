@@ -0,0 +1,148 @@
+"""
+Consumption rates and depletion forecasts.
+
+refresh_consumption loads the extraction history of the last CONSUMPTION_WINDOW_DAYS with one query into a DataFrame,
+converts the whole quantity column into the canonical unit of each stock's dimension with the unit converter and sums
+it per stock. The rate is that sum per day the stock was observed (the window, or its age if it is younger), the
+depletion date is when the remaining balance runs out at that rate. The stocks are summed per chemical and canonical
+unit. Both land in the summary tables StockConsumption and ChemicalConsumption, the dashboard only reads those.
+
+Refreshes are incremental: only stocks that are new, were edited, got or lost extractions since their row was computed
+or whose row is older than CONSUMPTION_MAX_AGE_HOURS (the window moved on) are computed again, and only the chemicals
+of those stocks are summed again.
+"""
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Max, Q
+from django.utils import timezone
+from .models import ChemicalConsumption, Extraction, Stock, StockConsumption
+from .units import get_unit_converter
+
+# No forecast further out than this, the stock is practically not used
+HORIZON_DAYS = 10 * 365
+
+STOCK_COLUMNS = ['stock', 'chemical', 'previous_chemical', 'unit', 'remaining_quantity', 'date_created',
+                 'extraction_count', 'last_extraction_id']
+
+
+def stale_stocks(now, full=False):
+    """Live stocks whose StockConsumption row is missing or outdated, all of them with full"""
+    stocks = Stock.objects.annotate(extraction_count=Count('extraction'), last_extraction_id=Max('extraction'))
+    if full:
+        return stocks
+    max_age = timedelta(hours=getattr(settings, 'CONSUMPTION_MAX_AGE_HOURS', 24))
+    return stocks.filter(Q(consumption__isnull=True) |
+                         Q(consumption__date_computed__lt=now - max_age) |
+                         Q(date_changed__gt=F('consumption__date_computed')) |
+                         ~Q(extraction_count=F('consumption__extraction_count')) |
+                         ~Q(last_extraction_id=F('consumption__last_extraction_id')))
+
+
+def depletion_dates(remaining, rate, today):
+    """Day each remaining balance runs out at its rate per day, None without balance, use or beyond HORIZON_DAYS"""
+    remaining, rate = np.asarray(remaining, dtype=float), np.asarray(rate, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        days = np.where(remaining <= 0, 0.0, remaining / rate)
+    forecast = np.isfinite(days) & (days <= HORIZON_DAYS)
+    dates = np.datetime64(today, 'D') + np.floor(np.where(forecast, days, 0)).astype('timedelta64[D]')
+    return [date if ok else None for date, ok in zip(dates.tolist(), forecast)]
+
+
+def compute(stocks, extractions, now, converter=None):
+    """
+    Consumption of stocks (DataFrame of STOCK_COLUMNS) from their extractions (DataFrame of stock, quantity and unit)
+    of the window before now. Returns the stocks with unit (canonical), rate per day, remaining and depletion_date.
+    """
+    converter = converter or get_unit_converter()
+    window = getattr(settings, 'CONSUMPTION_WINDOW_DAYS', 90)
+    stock_units, stock_factors = converter.canonical(stocks['unit'].to_numpy(dtype=np.int64))
+
+    # Extractions in a unit of another dimension can't be converted, Stock.convert_quantity counts them as 0 as well
+    units, factors = converter.canonical(extractions['unit'].to_numpy(dtype=np.int64))
+    stock_unit = pd.Series(stock_units, index=stocks['stock']).reindex(extractions['stock']).to_numpy()
+    amounts = np.where(units == stock_unit, extractions['quantity'].to_numpy(dtype=float) * factors, 0.0)
+    used = pd.Series(amounts).groupby(extractions['stock'].to_numpy()).sum()
+    used = used.reindex(stocks['stock'], fill_value=0.0).to_numpy()
+
+    age = (pd.Timestamp(now) - pd.to_datetime(stocks['date_created'], utc=True)).dt.total_seconds().to_numpy()
+    days = np.clip(np.minimum(age / 86400, window), 1, None)
+
+    result = stocks[['stock', 'chemical', 'extraction_count', 'last_extraction_id']].copy()
+    result['unit'] = stock_units
+    result['rate'] = used / days
+    result['remaining'] = stocks['remaining_quantity'].to_numpy(dtype=float) * stock_factors
+    result['depletion_date'] = depletion_dates(result['remaining'].to_numpy(), result['rate'].to_numpy(),
+                                               timezone.localdate(now))
+    return result
+
+
+def summarize(stocks, today):
+    """ChemicalConsumption of stocks (DataFrame of chemical, unit, rate and remaining) per chemical and unit"""
+    summary = stocks.groupby(['chemical', 'unit'], as_index=False).agg(
+        rate=('rate', 'sum'), remaining=('remaining', 'sum'), known=('remaining', 'count'), stocks=('rate', 'size'))
+    # Stocks without a stored balance (see sync_stock_quantities) don't count, none at all means unknown
+    summary['remaining'] = summary['remaining'].where(summary['known'] > 0)
+    summary['depletion_date'] = depletion_dates(summary['remaining'].to_numpy(), summary['rate'].to_numpy(), today)
+    return summary.drop(columns='known')
+
+
+def _records(frame, columns):
+    """Rows of frame as dicts of Python values, NaN as None"""
+    frame = frame[columns].astype(object)
+    return frame.where(frame.notna(), None).to_dict('records')
+
+
+def refresh_consumption(full=False, now=None, batch_size=1000):
+    """
+    Bring the summary tables up to date, see the module docstring. now is the time forecasts are made from, the
+    current time by default. Returns the number of stocks computed.
+    """
+    # Taken before reading, so changes made during the refresh are picked up by the next one
+    computed = timezone.now()
+    now = now or computed
+    converter = get_unit_converter(refresh=True)
+    stocks = pd.DataFrame.from_records(list(stale_stocks(now, full).values_list(
+        'pk', 'chemical_id', 'consumption__chemical_id', 'unit_id', 'remaining_quantity', 'date_created',
+        'extraction_count', 'last_extraction_id')), columns=STOCK_COLUMNS)
+
+    window = timedelta(days=getattr(settings, 'CONSUMPTION_WINDOW_DAYS', 90))
+    history = Extraction.objects.filter(date_created__gt=now - window, date_created__lte=now)
+    history = history.filter(stock__deleted_at=None) if full else history.filter(stock__in=stocks['stock'].tolist())
+    extractions = pd.DataFrame.from_records(list(history.values_list('stock_id', 'quantity', 'unit_id')),
+                                            columns=['stock', 'quantity', 'unit'])
+    consumption = compute(stocks, extractions, now, converter)
+
+    with transaction.atomic():
+        # Rows of stocks deleted since, archived stocks took theirs along
+        deleted = StockConsumption.objects.filter(stock__deleted_at__isnull=False)
+        chemicals = set(deleted.values_list('chemical_id', flat=True))
+        deleted.delete()
+        StockConsumption.objects.bulk_create(
+            [StockConsumption(stock_id=row.pop('stock'), chemical_id=row.pop('chemical'), unit_id=row.pop('unit'),
+                              date_computed=computed, **row)
+             for row in _records(consumption, ['stock', 'chemical', 'unit', 'rate', 'remaining', 'depletion_date',
+                                               'extraction_count', 'last_extraction_id'])],
+            update_conflicts=True, unique_fields=['stock'], batch_size=batch_size,
+            update_fields=['chemical', 'unit', 'rate', 'remaining', 'depletion_date', 'extraction_count',
+                           'last_extraction_id', 'date_computed'])
+
+        # Chemicals of the computed stocks, and those a stock was moved away from
+        chemicals.update(stocks['chemical'].tolist(), stocks['previous_chemical'].dropna().astype(int).tolist())
+        rows = StockConsumption.objects.all()
+        summaries = ChemicalConsumption.objects.all()
+        if not full:
+            rows = rows.filter(chemical__in=chemicals)
+            summaries = summaries.filter(chemical__in=chemicals)
+        totals = pd.DataFrame.from_records(list(rows.values_list('chemical_id', 'unit_id', 'rate', 'remaining')),
+                                           columns=['chemical', 'unit', 'rate', 'remaining'])
+        summary = summarize(totals, timezone.localdate(now))
+        summaries.delete()
+        ChemicalConsumption.objects.bulk_create(
+            [ChemicalConsumption(chemical_id=row.pop('chemical'), unit_id=row.pop('unit'), date_computed=computed,
+                                 **row)
+             for row in _records(summary, ['chemical', 'unit', 'rate', 'remaining', 'depletion_date', 'stocks'])],
+            batch_size=batch_size)
+    return len(consumption)
@@ -4,6 +4,11 @@ from django.apps import AppConfig
 class ChemmanagerConfig(AppConfig):
     name = 'chemmanager'
 
+    def ready(self):
+        import chemmanager.signals
+        # Before the first connection is opened, metrics installs its query recorder on each one
+        import chemmanager.metrics  # noqa: F401
+
 
 # TODO Nutzer Gruppen/AK Zuweisen
 # TODO Datenbank erweitern um mehr Funktionen
@@ -0,0 +1,51 @@
+"""
+Archive tier for soft deleted stocks.
+
+Stocks deleted longer ago than a cutoff are moved, together with their extractions, into ArchivedStock and
+ArchivedExtraction (same ids, same values) and removed from the live tables, so those hold the current inventory only.
+restore_stocks moves them back as live stocks.
+"""
+from django.db import transaction
+from .models import ArchivedExtraction, ArchivedStock, Extraction, Stock
+from . import fragments
+
+STOCK_FIELDS = [field.attname for field in ArchivedStock._meta.concrete_fields if field.name != 'date_archived']
+EXTRACTION_FIELDS = [field.attname for field in ArchivedExtraction._meta.concrete_fields]
+
+
+def _move(source, target, fields, pks):
+    target.objects.bulk_create([target(**row) for row in source.filter(pk__in=pks).values(*fields)])
+
+
+def archive_stocks(deleted_before, batch_size=500):
+    """Archive all stocks soft deleted before deleted_before, returns the number of stocks archived"""
+    candidates = Stock.objects_with_deleted.filter(deleted_at__lt=deleted_before).order_by('pk')
+    archived = 0
+    while True:
+        pks = list(candidates.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return archived
+        with transaction.atomic():
+            _move(Stock.objects_with_deleted, ArchivedStock, STOCK_FIELDS, pks)
+            extractions = list(Extraction.objects.filter(stock_id__in=pks).values_list('pk', flat=True))
+            _move(Extraction.objects, ArchivedExtraction, EXTRACTION_FIELDS, extractions)
+            # Queryset deletes: no soft delete and no rebooking of the extractions, the rows are gone for good
+            Extraction.objects.filter(stock_id__in=pks).delete()
+            Stock.objects_with_deleted.filter(pk__in=pks).delete()
+        archived += len(pks)
+
+
+def restore_stocks(pks):
+    """Move archived stocks back into the live tables and undelete them, returns the number restored"""
+    pks = list(ArchivedStock.objects.filter(pk__in=pks).values_list('pk', flat=True))
+    with transaction.atomic():
+        # bulk_create skips Stock.save and Extraction.save, the stored balance is copied as it was
+        stocks = [Stock(**row) for row in ArchivedStock.objects.filter(pk__in=pks).values(*STOCK_FIELDS)]
+        for stock in stocks:
+            stock.deleted_at = None
+        Stock.objects.bulk_create(stocks)
+        Extraction.objects.bulk_create([Extraction(**row) for row in ArchivedExtraction.objects
+                                        .filter(stock_id__in=pks).values(*EXTRACTION_FIELDS)])
+        ArchivedStock.objects.filter(pk__in=pks).delete()
+    fragments.bump({stock.chemical_id for stock in stocks})
+    return len(pks)
@@ -0,0 +1,324 @@
+"""
+Synthetic inventories and a benchmark of the views on top of them.
+
+generate_inventory fills the database with workgroups, users, a storage tree, chemicals with synonyms, stocks and
+extraction histories, mostly with bulk_create so even large scales are built in seconds. run_benchmarks builds each
+scale inside a transaction that is rolled back afterwards and records wall time, SQL queries and response size of
+every view. ``manage.py benchmark`` runs it on a throw-away test database and writes the results as JSON.
+"""
+import csv
+import os
+import platform
+import random
+import statistics
+import tempfile
+import threading
+import time
+from datetime import timedelta
+import django
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import OperationalError, connection, transaction
+from django.db.utils import ConnectionHandler
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from ChemData.database import sqlite_options
+from users.models import Profile, Workgroup
+from .importer import InventoryImporter
+from .models import Chemical, ChemicalSynonym, Distributor, Extraction, Stock, Storage, Unit
+from .search import rebuild_index, synonym_key
+from .units import invalidate_unit_converter
+from . import directory, fragments, typeahead
+
+SCALES = {
+    'tiny': dict(workgroups=2, users=1, storage_depth=2, storage_breadth=2, chemicals=20, synonyms=1, stocks=2,
+                 extractions=3, import_rows=50),
+    'small': dict(workgroups=2, users=2, storage_depth=2, storage_breadth=3, chemicals=200, synonyms=2, stocks=2,
+                  extractions=10, import_rows=500),
+    'medium': dict(workgroups=4, users=3, storage_depth=3, storage_breadth=3, chemicals=2000, synonyms=3, stocks=3,
+                   extractions=20, import_rows=5000),
+    'large': dict(workgroups=8, users=5, storage_depth=3, storage_breadth=4, chemicals=20000, synonyms=3, stocks=3,
+                  extractions=30, import_rows=50000),
+}
+
+SYLLABLES = ['meth', 'eth', 'prop', 'but', 'pent', 'hex', 'benz', 'chlor', 'brom', 'nitr', 'sulf', 'phen', 'tolu',
+             'acet', 'amin', 'hydr', 'ox', 'carb', 'fluor', 'iod']
+SUFFIXES = ['ane', 'anol', 'ene', 'ide', 'ate', 'ic acid', 'one', 'yl chloride', 'amine', 'al']
+
+
+def chemical_name(rng, index):
+    """Readable, unique name: random syllables plus the index"""
+    return ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 3))).capitalize() + \
+        rng.choice(SUFFIXES) + f' {index}'
+
+
+def _storage_tree(workgroup, depth, breadth, parent=None, level=1):
+    """All storages of a workgroup, breadth children per node down to depth levels"""
+    storages = []
+    for i in range(breadth):
+        name = f'{"Room" if level == 1 else "Shelf"} {level}.{i}'
+        if parent is None:
+            storage = Storage.add_root(name=name, abbreviation=f'{level}{i}', workgroup=workgroup)
+        else:
+            storage = parent.add_child(name=name, abbreviation=f'{level}{i}', workgroup=workgroup)
+        storages.append(storage)
+        if level < depth:
+            storages += _storage_tree(workgroup, depth, breadth, storage, level + 1)
+    return storages
+
+
+def generate_inventory(workgroups=2, users=2, storage_depth=2, storage_breadth=3, chemicals=200, synonyms=2,
+                       stocks=2, extractions=10, seed=0, **kwargs):
+    """
+    Build a synthetic inventory. chemicals, users and the storage tree are per workgroup, synonyms and stocks per
+    chemical, extractions per stock. Every storage is shared with the next workgroup. Returns a summary with the
+    created workgroups, users and counts.
+    """
+    rng = random.Random(seed)
+    now = timezone.now()
+    gram, _ = Unit.objects.get_or_create(name='g', defaults={'equals_standard': 1.0})
+    milligram, _ = Unit.objects.get_or_create(name='mg',
+                                              defaults={'equals_standard': 0.001, 'equals_standard_unit': gram})
+    Unit.objects.get_or_create(name='None', defaults={'equals_standard': 1.0})
+    distributors = Distributor.objects.bulk_create([Distributor(name=name) for name in ('Sigma', 'Merck', 'VWR')])
+
+    groups = Workgroup.objects.bulk_create([Workgroup(name=f'AK Bench {i}') for i in range(workgroups)])
+    # No per user hashing and no profile signals, the benchmark logs in with force_login
+    password = make_password(None)
+    members = User.objects.bulk_create([User(username=f'bench_{g}_{u}', password=password)
+                                        for g in range(workgroups) for u in range(users)])
+    Profile.objects.bulk_create([Profile(user=user, workgroup=groups[i // users]) for i, user in enumerate(members)])
+
+    summary = {'workgroups': groups, 'users': members, 'storages': 0, 'chemicals': 0, 'synonyms': 0, 'stocks': 0,
+               'extractions': 0}
+    for g, group in enumerate(groups):
+        storages = _storage_tree(group, storage_depth, storage_breadth)
+        for storage in storages:
+            storage.shared_workgroups.add(groups[(g + 1) % workgroups])
+        leaves = [storage for storage in storages if storage.depth == storage_depth] or storages
+        created = Chemical.objects.bulk_create([
+            Chemical(name=chemical_name(rng, i), cas=f'{rng.randint(50, 99999)}-{rng.randint(10, 99)}-{i % 10}',
+                     molar_mass=round(rng.uniform(16, 500), 2), workgroup=group, creator=members[g * users])
+            for i in range(chemicals)], batch_size=1000)
+        ChemicalSynonym.objects.bulk_create([
+            ChemicalSynonym(name=name, normalized_name=synonym_key(name), chemical=chemical)
+            for chemical in created for name in (f'{chemical.name} synonym {s}' for s in range(synonyms))],
+            batch_size=1000)
+
+        new_stocks = []
+        histories = []
+        for chemical in created:
+            for s in range(stocks):
+                quantity = rng.choice([100, 250, 500, 1000])
+                history = [(rng.uniform(0.5, 5), gram if rng.random() < 0.8 else milligram)
+                           for _ in range(extractions)]
+                used = sum(amount * (1 if unit == gram else 0.001) for amount, unit in history)
+                new_stocks.append(Stock(chemical=chemical, storage=rng.choice(leaves), unit=gram, quantity=quantity,
+                                        remaining_quantity=quantity - used, label=f'{s}',
+                                        distributor=rng.choice(distributors),
+                                        date_created=now - timedelta(days=rng.randint(30, 900))))
+                histories.append(history)
+        new_stocks = Stock.objects.bulk_create(new_stocks, batch_size=1000)
+        # bulk_create skips Extraction.save, the balances above already include the history
+        Extraction.objects.bulk_create([
+            Extraction(stock=stock, unit=unit, quantity=amount, user=rng.choice(members[g * users:(g + 1) * users]),
+                       date_created=stock.date_created + timedelta(days=day))
+            for stock, history in zip(new_stocks, histories) for day, (amount, unit) in enumerate(history)],
+            batch_size=2000)
+
+        summary['storages'] += len(storages)
+        summary['chemicals'] += len(created)
+        summary['synonyms'] += len(created) * synonyms
+        summary['stocks'] += len(new_stocks)
+        summary['extractions'] += len(new_stocks) * extractions
+    rebuild_index()
+    return summary
+
+
+def write_inventory_csv(path, rows, seed=0):
+    """An upload for the inventory import, every chemical twice, spread over ten storages"""
+    rng = random.Random(seed)
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file, delimiter=';')
+        writer.writerow(['chemical', 'quantity', 'unit', 'storage', 'label'])
+        for i in range(rows):
+            writer.writerow([chemical_name(rng, i // 2), 1, 'g', f'Import {i % 10}', i])
+
+
+def _measure(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            outcome = function()
+            timings.append(time.perf_counter() - start)
+    return outcome, {'seconds': statistics.median(timings), 'min_seconds': min(timings),
+                     'queries': len(context.captured_queries)}
+
+
+def _request(client, method, url, data=None):
+    response = getattr(client, method)(url, data)
+    size = len(b''.join(response.streaming_content) if response.streaming else response.content)
+    return {'status': response.status_code, 'bytes': size}
+
+
+def benchmark_views(summary, repeat=3, import_rows=500):
+    """Measure every view against an inventory built by generate_inventory, returns one result per view"""
+    user = summary['users'][0]
+    workgroup = summary['workgroups'][0]
+    chemical = Chemical.objects.filter(workgroup=workgroup).order_by('name').first()
+    stock = Stock.objects.filter(chemical__workgroup=workgroup).order_by('pk').first()
+    client = Client(raise_request_exception=False)
+    client.force_login(user)
+
+    requests = [
+        ('list', 'get', reverse('chemmanager-home'), None),
+        ('list_search', 'get', reverse('chemmanager-home'), {'q': chemical.name[:4]}),
+        ('list_shared', 'get', reverse('chemmanager-home'), {'p': [summary['workgroups'][-1].name]}),
+        ('table', 'get', reverse('chemical-table'), None),
+        ('detail', 'get', reverse('chemical-detail', args=[chemical.pk]), None),
+        ('api', 'get', reverse('api-chemicals'), {'limit': 100}),
+        ('typeahead', 'get', reverse('chemical-typeahead'), {'q': chemical.name[:3]}),
+        ('export_csv', 'get', reverse('chemical-export', args=['csv']), None),
+        ('extraction', 'post', reverse('extraction-create', args=[stock.pk]),
+         {'quantity': 0.1, 'unit': stock.unit_id, 'date_created': timezone.now().strftime('%Y-%m-%d %H:%M')}),
+        ('storage', 'get', reverse('storage-list'), None),
+    ]
+    results = []
+    for name, method, url, data in requests:
+        outcome, measured = _measure(lambda: _request(client, method, url, data), repeat)
+        results.append({'view': name, **outcome, **measured})
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'inventory.csv')
+        write_inventory_csv(path, import_rows)
+        columns = {'chemical': 0, 'quantity': 1, 'unit': 2, 'storage': 3, 'label': 4}
+        # Every run imports the same file again, later runs find the chemicals and storages of the first
+        _, measured = _measure(lambda: InventoryImporter(path, columns, user=user, workgroup=workgroup).run(), repeat)
+        results.append({'view': 'import', 'status': None, 'bytes': os.path.getsize(path), 'rows': import_rows,
+                        **measured})
+    return results
+
+
+class _Rollback(Exception):
+    pass
+
+
+def run_benchmarks(scales=('small',), repeat=3, seed=0):
+    """Benchmark every scale on a fresh inventory, nothing is left in the database afterwards"""
+    report = {
+        'date': timezone.now().isoformat(),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'repeat': repeat,
+        'scales': {},
+    }
+    for scale in scales:
+        parameters = SCALES[scale]
+        try:
+            with transaction.atomic():
+                start = time.perf_counter()
+                summary = generate_inventory(seed=seed, **parameters)
+                generated = time.perf_counter() - start
+                results = benchmark_views(summary, repeat=repeat, import_rows=parameters['import_rows'])
+                raise _Rollback()
+        except _Rollback:
+            pass
+        finally:
+            # The process caches may hold rows of the rolled back inventory
+            invalidate_unit_converter()
+            directory.invalidate()
+            fragments.invalidate()
+            typeahead.invalidate()
+        counts = {key: value for key, value in summary.items() if isinstance(value, int)}
+        report['scales'][scale] = {'parameters': parameters, 'counts': counts, 'generate_seconds': generated,
+                                   'results': results}
+    return report
+
+
+STRESS_PROFILES = {
+    # What settings.py used before: rollback journal, deferred transactions, the 5 s default timeout of sqlite3
+    'default': {},
+    'tuned': sqlite_options(),
+}
+
+
+def _stress_worker(handler, stock_ids, transactions, think, results):
+    connection = handler['default']
+    committed = locked = 0
+    try:
+        for i in range(transactions):
+            stock = stock_ids[i % len(stock_ids)]
+            try:
+                # Book an extraction the way Stock.save and Extraction.save do: read the balance, then write
+                # What transaction.atomic does, it only knows the connections of the project
+                connection.set_autocommit(False, force_begin_transaction_with_broken_autocommit=True)
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT remaining_quantity FROM stress_stock WHERE id = %s', [stock])
+                    cursor.fetchone()
+                    # The Python work between reading and writing, e.g. converting units
+                    time.sleep(think)
+                    cursor.execute('INSERT INTO stress_extraction (stock_id, quantity) VALUES (%s, %s)', [stock, 1])
+                    cursor.execute('UPDATE stress_stock SET remaining_quantity = remaining_quantity - 1 '
+                                   'WHERE id = %s', [stock])
+                connection.commit()
+                committed += 1
+            except OperationalError:
+                connection.rollback()
+                locked += 1
+            finally:
+                connection.set_autocommit(True)
+    finally:
+        connection.close()
+    results.append((committed, locked))
+
+
+def stress_writes(options, threads=8, transactions=200, stocks=10, think=0.001):
+    """
+    Concurrent extraction bookings from threads on a scratch SQLite file opened with the given OPTIONS. Returns the
+    committed transactions per second and the number that failed with "database is locked".
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        handler = ConnectionHandler({'default': {'ENGINE': 'django.db.backends.sqlite3',
+                                                 'NAME': os.path.join(tmp, 'stress.sqlite3'),
+                                                 'OPTIONS': options}})
+        connection = handler['default']
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE TABLE stress_stock (id INTEGER PRIMARY KEY, remaining_quantity REAL)')
+            cursor.execute('CREATE TABLE stress_extraction (id INTEGER PRIMARY KEY, stock_id INTEGER, quantity REAL)')
+            for stock in range(1, stocks + 1):
+                cursor.execute('INSERT INTO stress_stock VALUES (%s, %s)', [stock, threads * transactions])
+        connection.close()
+
+        results = []
+        workers = [threading.Thread(target=_stress_worker,
+                                    args=(handler, range(1, stocks + 1), transactions, think, results))
+                   for _ in range(threads)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        seconds = time.perf_counter() - start
+    committed = sum(result[0] for result in results)
+    return {'threads': threads, 'transactions': threads * transactions, 'committed': committed,
+            'locked': sum(result[1] for result in results), 'seconds': seconds,
+            'per_second': committed / seconds if seconds else 0}
+
+
+def compare(previous, current):
+    """Lines describing how much slower or faster each view got, for scales present in both reports"""
+    lines = []
+    for scale, data in current['scales'].items():
+        before = {row['view']: row for row in previous.get('scales', {}).get(scale, {}).get('results', [])}
+        for row in data['results']:
+            old = before.get(row['view'])
+            if old is None or not old['seconds']:
+                continue
+            lines.append(f'{scale:>6} {row["view"]:<12} {row["seconds"] * 1000:9.1f} ms '
+                         f'({row["seconds"] / old["seconds"]:5.2f}x)  {row["queries"]:4d} queries '
+                         f'({row["queries"] - old["queries"]:+d})')
+    return lines
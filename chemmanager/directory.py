@@ -0,0 +1,47 @@
+"""
+Directory of which workgroups share storage with which.
+
+Built from the Storage.shared_workgroups table with one query and kept in the Django cache. The signals drop it
+whenever sharing, storages or workgroup names change. Other processes only see that with a shared cache (CACHE_URL,
+see ChemData/cache.py); with the default process local cache they keep their copy, e.g. a revoked share, for up to
+CACHE_TIMEOUT.
+"""
+from django.core.cache import cache
+from .models import Storage
+
+CACHE_KEY = 'chemmanager:shared-workgroups'
+CACHE_TIMEOUT = 60 * 60
+
+
+def build():
+    """{workgroup id: {id: name of every workgroup with a storage shared with it}}"""
+    directory = {}
+    rows = Storage.shared_workgroups.through.objects \
+        .values_list('workgroup_id', 'storage__workgroup_id', 'storage__workgroup__name').distinct()
+    for shared_with, owner, name in rows:
+        if owner != shared_with:
+            directory.setdefault(shared_with, {})[owner] = name
+    return directory
+
+
+def get_directory():
+    directory = cache.get(CACHE_KEY)
+    if directory is None:
+        directory = build()
+        cache.set(CACHE_KEY, directory, CACHE_TIMEOUT)
+    return directory
+
+
+def invalidate():
+    cache.delete(CACHE_KEY)
+
+
+def sharing_workgroups(workgroup_id):
+    """{id: name} of the workgroups sharing storage with a workgroup"""
+    return get_directory().get(workgroup_id, {})
+
+
+def resolve(workgroup_id, names):
+    """Ids of the workgroups with the given names that share storage with a workgroup, other names are ignored"""
+    names = set(names)
+    return [pk for pk, name in sharing_workgroups(workgroup_id).items() if name in names]
@@ -0,0 +1,165 @@
+"""
+Streaming inventory export.
+
+Stocks are read with ``QuerySet.iterator`` as plain value tuples and encoded row by row, so the first bytes go out
+right away and memory stays bounded by chunk_size whatever the size of the inventory. XLSX is written as a minimal
+SpreadsheetML package through zipfile, which uses data descriptors when the output is not seekable.
+"""
+import csv
+import json
+import zipfile
+from xml.sax.saxutils import escape
+from django.db.models import TextField
+from django.db.models.functions import Coalesce
+from django.utils.encoding import force_str
+from .models import Stock
+
+COLUMNS = [
+    ('chemical', 'chemical__name'),
+    ('cas', 'chemical__cas'),
+    ('molar_mass', 'chemical__molar_mass'),
+    ('quantity', 'quantity'),
+    ('remaining_quantity', 'remaining_quantity'),
+    ('unit', 'unit__name'),
+    # Storages saved before the path was stored have none until rebuild_storage_paths ran
+    ('storage', Coalesce('storage__path_name', 'storage__name', output_field=TextField())),
+    ('label', 'label'),
+    ('distributor', 'distributor__name'),
+    ('purity', 'purity'),
+    ('date_created', 'date_created'),
+]
+HEADER = [title for title, _ in COLUMNS]
+
+FORMATS = {
+    'csv': 'text/csv',
+    'json': 'application/json',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+
+def inventory_rows(workgroup, chunk_size=2000):
+    """Value tuples (in COLUMNS order) of all live stocks of a workgroup's chemicals"""
+    return Stock.objects.filter(chemical__workgroup=workgroup) \
+        .order_by('chemical__name', 'pk') \
+        .values_list(*[field for _, field in COLUMNS]) \
+        .iterator(chunk_size=chunk_size)
+
+
+def _cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, (int, float)):
+        return value
+    return force_str(value)
+
+
+class _Echo:
+    """File-like object handing back what is written, see the Django docs on streaming large CSV files"""
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(HEADER)
+    for row in rows:
+        yield writer.writerow([_cell(value) for value in row])
+
+
+def stream_json(rows):
+    yield '['
+    separator = ''
+    for row in rows:
+        yield separator + json.dumps(dict(zip(HEADER, (_cell(value) for value in row))))
+        separator = ','
+    yield ']'
+
+
+class _Pipe:
+    """Unseekable write target for zipfile, the generator drains it after every write"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+XLSX_PARTS = {
+    '[Content_Types].xml':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>',
+    '_rels/.rels':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="xl/workbook.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+        '</Relationships>',
+    'xl/workbook.xml':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Inventory" sheetId="1" r:id="rId1"/></sheets></workbook>',
+    'xl/_rels/workbook.xml.rels':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="worksheets/sheet1.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>'
+        '</Relationships>',
+}
+
+
+def _xlsx_row(values):
+    cells = []
+    for value in values:
+        value = _cell(value)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            cells.append(f'<c><v>{value}</v></c>')
+        elif value != '':
+            cells.append(f'<c t="inlineStr"><is><t>{escape(value)}</t></is></c>')
+        else:
+            cells.append('<c/>')
+    return f'<row>{"".join(cells)}</row>'.encode()
+
+
+def stream_xlsx(rows, rows_per_write=500):
+    pipe = _Pipe()
+    with zipfile.ZipFile(pipe, 'w', compression=zipfile.ZIP_DEFLATED) as package:
+        for name, content in XLSX_PARTS.items():
+            package.writestr(name, content)
+        yield pipe.drain()
+        # force_zip64: the size of the sheet is not known up front
+        with package.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                        b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+            sheet.write(_xlsx_row(HEADER))
+            for count, row in enumerate(rows, 1):
+                sheet.write(_xlsx_row(row))
+                if count % rows_per_write == 0:
+                    yield pipe.drain()
+            sheet.write(b'</sheetData></worksheet>')
+    yield pipe.drain()
+
+
+STREAMS = {
+    'csv': stream_csv,
+    'json': stream_json,
+    'xlsx': stream_xlsx,
+}
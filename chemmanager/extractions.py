@@ -0,0 +1,91 @@
+"""
+Recording many extractions at once.
+
+record_extractions validates a whole batch of (stock, quantity, unit) rows against the access snapshot and the unit
+converter before anything is written: the stocks are loaded with one query, permissions and units are checked in
+memory. A valid batch is inserted with bulk_create and all touched balances are booked with a single UPDATE in the
+same transaction, so the batch is recorded completely or not at all.
+"""
+import math
+from collections import defaultdict
+from django.db import transaction
+from django.db.models import Case, F, FloatField, Value, When
+from django.utils import timezone
+from .models import Extraction, Stock
+from .units import resolve_unit, unit_factor
+from . import fragments
+
+
+class BatchError(ValueError):
+    """The batch was rejected, errors maps the index of each invalid row to its message"""
+
+    def __init__(self, errors):
+        super().__init__(f'{len(errors)} invalid rows')
+        self.errors = errors
+
+
+def validate(rows, access):
+    """
+    Extractions for rows of dicts with stock (pk), quantity and unit (pk or name), plus the conversion factor of each
+    into its stock's unit. Raises BatchError with all problems found.
+    """
+    stocks = Stock.objects.select_related('chemical').in_bulk({row['stock'] for row in rows})
+    errors = {}
+    extractions = []
+    for i, row in enumerate(rows):
+        stock = stocks.get(row['stock'])
+        if stock is None:
+            errors[i] = f'Stock {row["stock"]} does not exist'
+            continue
+        if not access.can_extract(stock):
+            errors[i] = f'You are not permitted to extract from {stock.chemical.name}'
+            continue
+        # json.loads and float() accept NaN and Infinity
+        if row['quantity'] is None or not math.isfinite(row['quantity']) or row['quantity'] <= 0:
+            errors[i] = 'Quantity must be a positive number'
+            continue
+        try:
+            unit = resolve_unit(row['unit'])
+        except KeyError:
+            errors[i] = f'Unknown unit {row["unit"]}'
+            continue
+        factor = unit_factor(unit, stock.unit_id)
+        if factor is None:
+            errors[i] = f'{stock.chemical.name} is not measured in this unit'
+            continue
+        extractions.append((Extraction(stock=stock, quantity=row['quantity'], unit_id=unit), factor))
+    if errors:
+        raise BatchError(errors)
+    return extractions
+
+
+def record_extractions(rows, access, user=None, comment=None, date_created=None):
+    """
+    Validate and record a batch, see validate for rows. Returns the stocks whose balance is used up, in the order of
+    their first row.
+    """
+    extractions = validate(rows, access)
+    date_created = date_created or timezone.now()
+    used = defaultdict(float)
+    for extraction, factor in extractions:
+        extraction.user = user
+        extraction.comment = comment
+        extraction.date_created = date_created
+        used[extraction.stock_id] += extraction.quantity * factor
+    stocks = {extraction.stock_id: extraction.stock for extraction, _ in extractions}
+
+    with transaction.atomic():
+        # bulk_create skips Extraction.save, the balances are booked below for all stocks at once
+        Extraction.objects.bulk_create([extraction for extraction, _ in extractions])
+        Stock.objects_with_deleted.filter(pk__in=used).update(remaining_quantity=Case(
+            *[When(pk=pk, then=F('remaining_quantity') - Value(amount)) for pk, amount in used.items()],
+            output_field=FloatField()))
+        balances = dict(Stock.objects_with_deleted.filter(pk__in=used).values_list('pk', 'remaining_quantity'))
+    # No post_save either, the cards of the chemical list are outdated here
+    fragments.bump({stock.chemical_id for stock in stocks.values()})
+
+    for pk, stock in stocks.items():
+        stock.remaining_quantity = balances[pk]
+    # Balances of old stocks may not be stored yet (see sync_stock_quantities), those are not reported
+    return [stock for stock in stocks.values() if stock.remaining_quantity is not None and
+            stock.remaining_quantity <= 0]
@@ -1,4 +1,5 @@
 from django import forms
+from django.utils import timezone
 from dal import autocomplete
 from .models import Chemical, Stock, Extraction, Storage, ChemicalList, ChemicalSynonym
 
@@ -94,6 +95,36 @@ class ExtractionCreateForm(forms.ModelForm):
         }
 
 
+class ExtractionBatchForm(forms.Form):
+    """What all rows of a batch share"""
+    date_created = forms.DateTimeField(initial=timezone.now)
+    comment = forms.CharField(required=False, widget=forms.Textarea(attrs={'rows': 2}))
+    anonymous = forms.BooleanField(required=False, label='stay anonymous')
+
+
+class ExtractionBatchRowForm(forms.Form):
+    """One row of a batch, rows without a quantity (e.g. a listed stock nothing was taken from) are skipped"""
+    stock = forms.IntegerField(min_value=1, required=False)
+    quantity = forms.FloatField(required=False)
+    unit = forms.TypedChoiceField(coerce=int, required=False, empty_value=None)
+
+    def __init__(self, *args, units=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        # Choices instead of a ModelChoiceField, which would query its unit for every row
+        self.fields['unit'].choices = [('', '---------')] + list(units)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get('quantity') is not None:
+            for field in ('stock', 'unit'):
+                if cleaned_data.get(field) is None and field not in self.errors:
+                    self.add_error(field, 'This field is required.')
+        return cleaned_data
+
+
+ExtractionBatchFormSet = forms.formset_factory(ExtractionBatchRowForm, extra=5)
+
+
 class ChemicalListUploadForm(forms.ModelForm):
     class Meta:
         model = ChemicalList
@@ -110,7 +141,7 @@ class ChemicalListVerifyForm(forms.Form):
 
         choices = [('', '--')] + [(f.name, f.name) for f in Stock._meta.get_fields()]
         # Remove prepopulated entries
-        choices = [x for x in choices if x not in (2 * ('id',), 2 * ('softdeletemodel_ptr',), 2 * ('deleted_at',), 2 * ('extraction', ), 2 * ('date_changed',))]
+        choices = [x for x in choices if x not in (2 * ('id',), 2 * ('softdeletemodel_ptr',), 2 * ('deleted_at',), 2 * ('extraction', ), 2 * ('date_changed',), 2 * ('remaining_quantity',))]
         choices = [f if f[1] not in Stock.get_required_fields() else (f[0], f[1] + '*') for f in choices]
         # makes new list without id, softdelete_pzt etc.
         # TODO filter choices (no id), capitalize,default option
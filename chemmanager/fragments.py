@@ -0,0 +1,58 @@
+"""
+Cache of the rendered chemical cards of the chemical list.
+
+A card is cached under the version stamp of its chemical, the generation of what all cards share (storages,
+workgroups, units, distributors) and everything that differs between viewers: the workgroup, which decides the
+visible stocks and edit links, and the user agent class, which decides the columns. The signals bump a chemical's
+stamp when it, its stocks, extractions or synonyms change and the generation on shared changes. Outdated cards are
+never looked up again and expire from the Django cache.
+"""
+import time
+from django.core.cache import cache
+
+CARD_TIMEOUT = 24 * 60 * 60
+VERSION_KEY = 'chemmanager:card-version:{}'
+GENERATION_KEY = 'chemmanager:card-generation'
+
+
+def _stamps(keys):
+    """Current stamps of keys, keys without one (new or evicted) get a fresh one that was never used before"""
+    stamps = cache.get_many(keys)
+    missing = {key: time.time_ns() for key in keys if key not in stamps}
+    if missing:
+        cache.set_many(missing, None)
+        stamps.update(missing)
+    return stamps
+
+
+def bump(chemical_ids):
+    """Outdate the cards of these chemicals"""
+    cache.delete_many([VERSION_KEY.format(pk) for pk in chemical_ids if pk is not None])
+
+
+def invalidate():
+    """Outdate every card"""
+    cache.delete(GENERATION_KEY)
+
+
+def card_keys(chemical_ids, viewer):
+    """{chemical id: cache key of its card}, viewer is a string of everything the card depends on besides the data"""
+    versions = {pk: VERSION_KEY.format(pk) for pk in chemical_ids}
+    stamps = _stamps([GENERATION_KEY, *versions.values()])
+    return {pk: f'chemmanager:card:{pk}:{stamps[key]}:{stamps[GENERATION_KEY]}:{viewer}'
+            for pk, key in versions.items()}
+
+
+def get_cards(chemicals, viewer, render):
+    """
+    Rendered cards of the chemicals in the same order. render is called once with the chemicals that are not cached
+    and returns their cards in the same order.
+    """
+    keys = card_keys([chemical.pk for chemical in chemicals], viewer)
+    cards = cache.get_many(list(keys.values()))
+    missing = [chemical for chemical in chemicals if keys[chemical.pk] not in cards]
+    if missing:
+        rendered = {keys[chemical.pk]: card for chemical, card in zip(missing, render(missing))}
+        cache.set_many(rendered, CARD_TIMEOUT)
+        cards.update(rendered)
+    return [cards[keys[chemical.pk]] for chemical in chemicals]
@@ -0,0 +1,76 @@
+"""
+Content addressed image store.
+
+Uploaded images are saved under the SHA-256 of their content (``<folder>/<hash><ext>``), so identical pictures are
+stored once and saving a model whose image did not change does not touch the file at all. Thumbnails are written
+once per size to ``thumbs/<size>/<name>.png`` by the 'thumbnails' job, never inside the request.
+"""
+import hashlib
+import os
+from io import BytesIO
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image
+
+
+def content_name(file, folder, extension):
+    digest = hashlib.sha256()
+    file.seek(0)
+    for chunk in iter(lambda: file.read(64 * 1024), b''):
+        digest.update(chunk)
+    file.seek(0)
+    return f'{folder}/{digest.hexdigest()}{extension.lower()}'
+
+
+def store_file(file, folder, extension, storage=default_storage):
+    """Save file under its content hash unless that content is already stored, returns the storage name"""
+    name = content_name(file, folder, extension)
+    if not storage.exists(name):
+        name = storage.save(name, file)
+    return name
+
+
+def content_address(field_file):
+    """
+    Store a freshly assigned (uncommitted) upload of an ImageField/FileField by content and point the field at it.
+    Returns True if the field got new content, False if nothing was uploaded.
+    """
+    if not field_file or field_file._committed:
+        return False
+    folder = field_file.field.upload_to
+    extension = os.path.splitext(field_file.name)[1] or '.png'
+    field_file.name = store_file(field_file.file, folder, extension, storage=field_file.storage)
+    # Nothing left for FileField.pre_save to write
+    field_file._committed = True
+    return True
+
+
+def thumbnail_name(name, size):
+    return f'thumbs/{size}/{os.path.splitext(name)[0]}.png'
+
+
+def thumbnail_url(field_file, size, storage=default_storage):
+    """URL of the thumbnail if it was generated already, otherwise of the image itself"""
+    if not field_file:
+        return None
+    thumbnail = thumbnail_name(field_file.name, size)
+    if storage.exists(thumbnail):
+        return storage.url(thumbnail)
+    return field_file.url
+
+
+def generate_thumbnails(name, sizes, storage=default_storage):
+    """Write missing thumbnails (max. size x size pixels) of a stored image, returns the number written"""
+    missing = [size for size in sizes if not storage.exists(thumbnail_name(name, size))]
+    if not missing or not storage.exists(name):
+        return 0
+    with storage.open(name) as file, Image.open(file) as img:
+        if img.mode not in ('1', 'L', 'LA', 'P', 'RGB', 'RGBA'):
+            img = img.convert('RGBA')
+        for size in missing:
+            thumbnail = img.copy()
+            thumbnail.thumbnail((size, size))
+            buffer = BytesIO()
+            thumbnail.save(buffer, format='PNG')
+            storage.save(thumbnail_name(name, size), ContentFile(buffer.getvalue()))
+    return len(missing)
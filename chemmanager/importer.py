@@ -0,0 +1,87 @@
+import pandas as pd
+from django.db import transaction
+from .models import Chemical, Stock, Storage, Unit
+from .search import index_chemicals
+from . import fragments, typeahead
+
+
+def read_inventory(path, **kwargs):
+    """Read an uploaded inventory, the separator is sniffed like in the upload preview"""
+    return pd.read_csv(path, engine='python', sep=None, dtype=str, keep_default_na=False, **kwargs)
+
+
+class InventoryImporter:
+    """
+    Import an uploaded inventory csv as stocks of a workgroup.
+
+    The file is read in chunks. Chemicals, units and storages are resolved once into lookup dictionaries (missing
+    chemicals and storages are created on first sight) and each chunk is written with bulk_create in its own
+    transaction. progress is called with the number of imported rows after every chunk.
+    """
+
+    def __init__(self, path, columns, user, workgroup, chunk_size=5000, progress=None):
+        self.path = path
+        # Stock field name -> column index in the file
+        self.columns = columns
+        self.user = user
+        self.workgroup = workgroup
+        self.chunk_size = chunk_size
+        self.progress = progress
+
+    def _load_lookups(self):
+        self.chemicals = dict(Chemical.objects.filter(workgroup=self.workgroup).values_list('name', 'pk'))
+        self.storages = dict(Storage.objects.filter(workgroup=self.workgroup).values_list('name', 'pk'))
+        self.units = dict(Unit.objects.values_list('name', 'pk'))
+
+    def _column(self, chunk, field, default=None):
+        if field not in self.columns:
+            return [default] * len(chunk)
+        return chunk.iloc[:, self.columns[field]].tolist()
+
+    def _unit(self, name):
+        if name in self.units:
+            return self.units[name]
+        if 'None' not in self.units:
+            raise Unit.DoesNotExist('Unit "None" is required for stocks without a known unit')
+        return self.units['None']
+
+    def _storage(self, name):
+        if name not in self.storages:
+            self.storages[name] = Storage.add_root(name=name, creator=self.user, workgroup=self.workgroup).pk
+        return self.storages[name]
+
+    def _resolve_chemicals(self, names):
+        missing = [name for name in dict.fromkeys(names) if name not in self.chemicals]
+        if missing:
+            created = Chemical.objects.bulk_create([Chemical(name=name, creator=self.user, workgroup=self.workgroup)
+                                                    for name in missing])
+            # bulk_create sends no post_save, the search indexes are updated here
+            index_chemicals(created)
+            typeahead.invalidate(self.workgroup.pk if self.workgroup else None)
+            self.chemicals.update((chemical.name, chemical.pk) for chemical in created)
+
+    def _import_chunk(self, chunk):
+        names = self._column(chunk, 'chemical')
+        self._resolve_chemicals(names)
+        # TODO convert quantity to float, until then imported stocks are marked with -1
+        quantity = -1
+        stocks = [Stock(chemical_id=self.chemicals[name], quantity=quantity, remaining_quantity=quantity,
+                        unit_id=self._unit(unit), label=label, storage_id=self._storage(storage))
+                  for name, unit, label, storage in zip(names,
+                                                        self._column(chunk, 'unit'),
+                                                        self._column(chunk, 'label'),
+                                                        # Without a storage column everything goes to "default"
+                                                        self._column(chunk, 'storage', default='default'))]
+        Stock.objects.bulk_create(stocks, batch_size=1000)
+        fragments.bump({stock.chemical_id for stock in stocks})
+        return len(stocks)
+
+    def run(self):
+        self._load_lookups()
+        imported = 0
+        for chunk in read_inventory(self.path, chunksize=self.chunk_size):
+            with transaction.atomic():
+                imported += self._import_chunk(chunk)
+            if self.progress is not None:
+                self.progress(imported)
+        return imported
@@ -0,0 +1,105 @@
+"""
+Database backed job queue, no broker needed.
+
+Views enqueue a Job row and return immediately; ``manage.py run_jobs`` claims queued jobs one at a time and runs the
+handler registered for their kind. Handlers receive the job (for progress reports) and its stored arguments, and
+return a short message shown to the user.
+"""
+import logging
+from django.utils import timezone
+from .models import Chemical, ChemicalList, Job
+from .images import generate_thumbnails
+from .importer import InventoryImporter
+from .utils import PubChemLoader
+
+logger = logging.getLogger(__name__)
+
+HANDLERS = {}
+
+
+def register(kind):
+    def decorator(function):
+        HANDLERS[kind] = function
+        return function
+    return decorator
+
+
+def enqueue(kind, user=None, **arguments):
+    if kind not in HANDLERS:
+        raise ValueError(f'No job handler registered for "{kind}"')
+    return Job.objects.create(kind=kind, user=user, arguments=arguments)
+
+
+def claim_next():
+    """Mark the oldest queued job as running and return it, None if the queue is empty"""
+    while True:
+        job = Job.objects.filter(status=Job.QUEUED).order_by('date_created', 'pk').first()
+        if job is None:
+            return None
+        # Another worker may have been faster, only the one that flips the status owns the job
+        if Job.objects.filter(pk=job.pk, status=Job.QUEUED).update(status=Job.RUNNING,
+                                                                   date_started=timezone.now()) == 1:
+            job.refresh_from_db()
+            return job
+
+
+def run(job):
+    try:
+        message = HANDLERS[job.kind](job, **job.arguments) or ''
+        status = Job.DONE
+    except Exception as error:
+        logger.exception('Job %s (%s) failed', job.pk, job.kind)
+        message = f'{type(error).__name__}: {error}'
+        status = Job.FAILED
+    Job.objects.filter(pk=job.pk).update(status=status, message=message, date_finished=timezone.now())
+    job.refresh_from_db()
+    return job
+
+
+def run_pending(limit=None):
+    """Run queued jobs until the queue is empty (or limit jobs ran), returns the number of jobs"""
+    count = 0
+    while limit is None or count < limit:
+        job = claim_next()
+        if job is None:
+            break
+        run(job)
+        count += 1
+    return count
+
+
+def requeue_stale(started_before):
+    """Put jobs back into the queue whose worker died while running them"""
+    return Job.objects.filter(status=Job.RUNNING, date_started__lt=started_before) \
+        .update(status=Job.QUEUED, date_started=None, progress=0)
+
+
+@register('import_inventory')
+def import_inventory(job, chemicallist, columns):
+    chemicallist = ChemicalList.objects.get(pk=chemicallist)
+    with open(chemicallist.file.path) as file:
+        job.set_progress(0, total=max(sum(1 for _ in file) - 1, 0))
+    importer = InventoryImporter(chemicallist.file.path, columns, user=job.user, workgroup=chemicallist.workgroup,
+                                 progress=job.set_progress)
+    return f'{importer.run()} stocks imported.'
+
+
+@register('enrich_chemical')
+def enrich_chemical(job, chemical):
+    """Fill structure, molar mass and CID of a chemical from PubChem"""
+    chemical = Chemical.objects.get(pk=chemical)
+    pubchemloader = PubChemLoader(chemical_name=chemical.name)
+    if pubchemloader.compound is None:
+        return f'Could not find {chemical.name} on PubChem.'
+    initial_dict = pubchemloader.generate_initial({'structure': chemical.structure,
+                                                   'molar_mass': chemical.molar_mass})
+    for field, value in initial_dict.items():
+        setattr(chemical, field, value)
+    # save, not update(): the post_save receivers refresh the search index and the chemical cards
+    chemical.save(update_fields=list(initial_dict))
+    return f'{chemical.name} updated from PubChem.'
+
+
+@register('thumbnails')
+def thumbnails(job, name, sizes):
+    return f'{generate_thumbnails(name, sizes)} thumbnails written.'
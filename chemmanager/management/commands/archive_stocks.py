@@ -0,0 +1,32 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from chemmanager.archive import archive_stocks, restore_stocks
+from chemmanager.models import Stock
+
+
+class Command(BaseCommand):
+    help = 'Move stocks soft deleted more than --days ago (with their extractions) into the archive tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=getattr(settings, 'STOCK_ARCHIVE_DAYS', 365),
+                            help='Archive stocks deleted more than this many days ago')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the stocks that would be archived')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--restore', type=int, nargs='+', metavar='ID',
+                            help='Move these archived stocks back into the inventory instead')
+
+    def handle(self, *args, **options):
+        if options['restore']:
+            restored = restore_stocks(options['restore'])
+            self.stdout.write(self.style.SUCCESS(f'Restored {restored} of {len(options["restore"])} stocks'))
+            return
+
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        if options['dry_run']:
+            count = Stock.objects_with_deleted.filter(deleted_at__lt=cutoff).count()
+            self.stdout.write(f'{count} stocks deleted before {cutoff:%Y-%m-%d} would be archived')
+            return
+        archived = archive_stocks(cutoff, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Archived {archived} stocks deleted before {cutoff:%Y-%m-%d}'))
@@ -0,0 +1,38 @@
+import json
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from chemmanager.benchmark import SCALES, compare, run_benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the views on synthetic inventories (in a throw-away test database) and save the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scales', nargs='+', choices=list(SCALES), default=['small', 'medium'])
+        parser.add_argument('--repeat', type=int, default=3, help='Runs per view, the median is reported')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', default='benchmark.json', help='File the results are written to')
+        parser.add_argument('--compare', metavar='FILE', help='Earlier results to compare with')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            report = run_benchmarks(options['scales'], repeat=options['repeat'], seed=options['seed'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        with open(options['output'], 'w') as file:
+            json.dump(report, file, indent=2)
+        for scale, data in report['scales'].items():
+            self.stdout.write(f'{scale}: {data["counts"]} generated in {data["generate_seconds"]:.1f} s')
+            for row in data['results']:
+                self.stdout.write(f'  {row["view"]:<12} {row["seconds"] * 1000:9.1f} ms {row["queries"]:5d} queries '
+                                  f'status {row["status"]}')
+        if options['compare']:
+            with open(options['compare']) as file:
+                self.stdout.write('\n'.join(compare(json.load(file), report)))
+        self.stdout.write(self.style.SUCCESS(f'Results written to {options["output"]}'))
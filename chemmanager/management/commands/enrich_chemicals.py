@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from chemmanager.models import Chemical
+from chemmanager.pubchem import PubChemRestClient, enrich_chemicals
+from chemmanager.utils import import_pubchem_synonyms
+
+
+class Command(BaseCommand):
+    help = 'Fill missing CID, structure and molar mass of chemicals from PubChem'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='Concurrent requests')
+        parser.add_argument('--rate', type=float, default=5, help='Requests per second (PubChem allows 5)')
+        parser.add_argument('--retries', type=int, default=3)
+        parser.add_argument('--batch-size', type=int, default=100, help='CIDs per property request')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Chemicals per database round')
+        parser.add_argument('--workgroup', type=int, default=None, help='Only chemicals of this workgroup id')
+        parser.add_argument('--api-url', default=None, help='PUG REST base url, e.g. a local stub')
+        parser.add_argument('--synonyms', action='store_true',
+                            help='Afterwards add the PubChem synonyms of all chemicals with a CID')
+        parser.add_argument('--synonym-limit', type=int, default=10, help='Most common synonyms added per chemical')
+
+    def handle(self, *args, **options):
+        chemicals = Chemical.objects.filter(Q(cid__isnull=True) | Q(cid='') | Q(structure__isnull=True) |
+                                            Q(structure='') | Q(molar_mass__isnull=True)).order_by('pk')
+        if options['workgroup'] is not None:
+            chemicals = chemicals.filter(workgroup_id=options['workgroup'])
+        client = PubChemRestClient(base_url=options['api_url'], rate=options['rate'], retries=options['retries'])
+
+        totals = {'updated': 0, 'not_found': 0, 'failed': 0}
+        ids = list(chemicals.values_list('pk', flat=True))
+        for start in range(0, len(ids), options['chunk_size']):
+            stats = enrich_chemicals(Chemical.objects.filter(pk__in=ids[start:start + options['chunk_size']]),
+                                     client=client, workers=options['workers'], batch_size=options['batch_size'])
+            for key, value in stats.items():
+                totals[key] += value
+            self.stdout.write(f'{min(start + options["chunk_size"], len(ids))}/{len(ids)} chemicals processed')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{totals["updated"]} updated, {totals["not_found"]} not found on PubChem, {totals["failed"]} failed'))
+        if options['synonyms']:
+            self.import_synonyms(client, options)
+
+    def import_synonyms(self, client, options):
+        chemicals = Chemical.objects.exclude(Q(cid__isnull=True) | Q(cid='')).order_by('pk')
+        if options['workgroup'] is not None:
+            chemicals = chemicals.filter(workgroup_id=options['workgroup'])
+        added = failed = 0
+        ids = list(chemicals.values_list('pk', flat=True))
+        for start in range(0, len(ids), options['chunk_size']):
+            stats = import_pubchem_synonyms(Chemical.objects.filter(pk__in=ids[start:start + options['chunk_size']]),
+                                            client=client, limit=options['synonym_limit'],
+                                            batch_size=options['batch_size'])
+            added += stats['added']
+            failed += stats['failed']
+        self.stdout.write(self.style.SUCCESS(f'{added} synonyms added, {failed} chemicals failed'))
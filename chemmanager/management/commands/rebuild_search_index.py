@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from chemmanager.search import normalize_synonyms, rebuild_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the trigram search index over chemical names, synonyms and CAS numbers and the normalized synonyms'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            normalized = normalize_synonyms(batch_size=options['batch_size'])
+            count = rebuild_index(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} terms, normalized {normalized} synonyms'))
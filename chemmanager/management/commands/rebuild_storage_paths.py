@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from chemmanager.models import Storage
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the stored display path and abbreviation of every Storage'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            for root in Storage.get_root_nodes():
+                root.refresh_paths()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt paths of {Storage.objects.count()} storages'))
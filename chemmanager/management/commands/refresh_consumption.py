@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from chemmanager.analytics import refresh_consumption
+
+
+class Command(BaseCommand):
+    help = 'Update the consumption rates and depletion forecasts of stocks that changed (see chemmanager.analytics)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='Recompute every stock, not only the changed ones')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        computed = refresh_consumption(full=options['full'], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Computed the consumption of {computed} stocks'))
@@ -0,0 +1,33 @@
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+from chemmanager import jobs
+
+
+class Command(BaseCommand):
+    help = 'Worker for background jobs (inventory imports, PubChem enrichment)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Exit when the queue is empty')
+        parser.add_argument('--sleep', type=float, default=2.0, help='Seconds to wait when the queue is empty')
+        parser.add_argument('--requeue-after', type=int, default=None, metavar='MINUTES',
+                            help='Requeue jobs that are running longer than this at startup (dead workers)')
+
+    def handle(self, *args, **options):
+        if options['requeue_after'] is not None:
+            requeued = jobs.requeue_stale(timezone.now() - timedelta(minutes=options['requeue_after']))
+            self.stdout.write(f'Requeued {requeued} stale jobs')
+
+        while True:
+            close_old_connections()
+            job = jobs.claim_next()
+            if job is None:
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
+                continue
+            self.stdout.write(f'Running job {job.pk} ({job.kind})')
+            job = jobs.run(job)
+            self.stdout.write(f'Job {job.pk} {job.status}: {job.message}')
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from chemmanager.benchmark import STRESS_PROFILES, stress_writes
+
+
+class Command(BaseCommand):
+    help = 'Book extractions from many threads on a scratch SQLite file, with the old and the tuned database profile'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--transactions', type=int, default=200, help='Transactions per thread')
+        parser.add_argument('--think', type=float, default=0.001,
+                            help='Seconds between reading and writing in each transaction')
+
+    def handle(self, *args, **options):
+        for name, database_options in STRESS_PROFILES.items():
+            result = stress_writes(database_options, threads=options['threads'],
+                                   transactions=options['transactions'], think=options['think'])
+            self.stdout.write(f'{name:<8} {result["committed"]:6d} of {result["transactions"]} committed in '
+                              f'{result["seconds"]:.2f} s ({result["per_second"]:.0f}/s), '
+                              f'{result["locked"]} failed with "database is locked"')
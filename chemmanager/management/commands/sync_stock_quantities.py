@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+from chemmanager.models import Stock, Extraction
+from chemmanager import fragments
+
+
+class Command(BaseCommand):
+    help = 'Recompute Stock.remaining_quantity from the extraction history and report drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report drift, do not write')
+        parser.add_argument('--tolerance', type=float, default=1e-9,
+                            help='Differences below this value are not reported as drift')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        # One grouped query for the whole history: {stock_id: [(unit_id, total), ...]}
+        totals = {}
+        for row in Extraction.objects.order_by().values('stock', 'unit').annotate(total=Sum('quantity')):
+            totals.setdefault(row['stock'], []).append((row['unit'], row['total']))
+
+        changed = []
+        drift = 0
+        checked = 0
+        stocks = Stock.objects_with_deleted.select_related('unit').order_by('pk')
+        for stock in stocks.iterator(chunk_size=options['batch_size']):
+            checked += 1
+            extracted = sum(stock.convert_quantity(total, unit_id)
+                            for unit_id, total in totals.get(stock.pk, []))
+            computed = stock.quantity - extracted
+            if stock.remaining_quantity is not None and \
+                    abs(stock.remaining_quantity - computed) > options['tolerance']:
+                drift += 1
+                self.stdout.write(f'Stock {stock.pk}: stored {stock.remaining_quantity}, '
+                                  f'history {computed}')
+            if stock.remaining_quantity != computed:
+                stock.remaining_quantity = computed
+                changed.append(stock)
+
+        if not options['dry_run']:
+            with transaction.atomic():
+                Stock.objects_with_deleted.bulk_update(changed, ['remaining_quantity'],
+                                                       batch_size=options['batch_size'])
+            # bulk_update sends no post_save, the cards show the old balances
+            fragments.invalidate()
+
+        action = 'would update' if options['dry_run'] else 'updated'
+        self.stdout.write(self.style.SUCCESS(f'Checked {checked} stocks, {drift} drifted, {action} {len(changed)}'))
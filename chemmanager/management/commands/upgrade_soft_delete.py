@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, models
+from chemmanager.models import Stock
+
+# Layout before SoftDeleteModel became abstract: deleted_at lived in the parent table, stocks pointed at their row
+PARENT_TABLE = 'chemmanager_softdeletemodel'
+PARENT_LINK = 'softdeletemodel_ptr_id'
+
+
+def _integer_key(column):
+    """Stand-in for a former primary key column of Stock, for schema_editor.alter_field"""
+    field = models.IntegerField(primary_key=True)
+    field.set_attributes_from_name(column)
+    field.model = Stock
+    return field
+
+
+class Command(BaseCommand):
+    help = 'Move the soft delete timestamps of stocks from the former SoftDeleteModel table into the stock table ' \
+           '(SQLite only)'
+
+    def handle(self, *args, **options):
+        # Databases older than the abstract SoftDeleteModel were always SQLite, DATABASE_URL came later
+        if connection.vendor != 'sqlite':
+            raise CommandError(f'upgrade_soft_delete only converts SQLite databases, not {connection.vendor}')
+
+        table = Stock._meta.db_table
+        with connection.cursor() as cursor:
+            tables = connection.introspection.table_names(cursor)
+            columns = [column.name for column in connection.introspection.get_table_description(cursor, table)]
+        if PARENT_TABLE not in tables or PARENT_LINK not in columns:
+            self.stdout.write('Stocks already store deleted_at in their own table, nothing to do')
+            return
+
+        # One transaction: the parent table is only dropped once every timestamp has been copied
+        with connection.schema_editor() as editor:
+            quote = editor.quote_name
+            editor.add_field(Stock, Stock._meta.get_field('deleted_at'))
+            editor.execute(f'UPDATE {quote(table)} SET {quote("deleted_at")} = (SELECT parent.{quote("deleted_at")} '
+                           f'FROM {quote(PARENT_TABLE)} parent WHERE parent.{quote("id")} = {quote(PARENT_LINK)})')
+            # Renamed in place first, SQLite points the foreign keys of extractions, consumption rows, ... at id
+            editor.alter_field(Stock, _integer_key(PARENT_LINK), _integer_key('id'))
+            # Then rebuilt from the model: autoincrementing id, no link to the parent and the indexes of Stock.Meta
+            editor.alter_field(Stock, _integer_key('id'), Stock._meta.pk)
+            editor.execute(f'DROP TABLE {quote(PARENT_TABLE)}')
+
+        deleted = Stock.objects_with_deleted.filter(deleted_at__isnull=False).count()
+        self.stdout.write(self.style.SUCCESS(f'Moved deleted_at into {table}, {deleted} stocks are soft deleted'))
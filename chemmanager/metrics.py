@@ -0,0 +1,232 @@
+"""
+Request metrics per view.
+
+RequestMetricsMiddleware times every request and, through a database execute wrapper (works without DEBUG), counts
+its SQL queries and their time, keeping only the slowest few statements. The wrapper is installed on every connection
+when it is opened and reports to the recorder of the current context, so the queries of async views, which run on
+sync_to_async threads with connections of their own, are counted as well. Template render time is measured for
+TemplateResponses (all class based views), response size by counting the bytes sent. Everything is aggregated per
+resolved view name in the process wide registry, served in the Prometheus text format by MetricsView. Requests
+slower than METRICS_SLOW_REQUEST_SECONDS are logged with their slowest queries.
+"""
+import heapq
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# QueryRecorder of the request being handled, copied into the threads of sync_to_async
+current_recorder = ContextVar('current_recorder', default=None)
+
+
+class QueryRecorder:
+    """Database execute wrapper counting queries and keeping the slowest ones"""
+
+    def __init__(self, keep=3):
+        self.keep = keep
+        self.count = 0
+        self.seconds = 0.0
+        self.slowest = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.count += 1
+            self.seconds += duration
+            if len(self.slowest) < self.keep:
+                heapq.heappush(self.slowest, (duration, self.count, sql))
+            elif duration > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, (duration, self.count, sql))
+
+
+class ViewStats:
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.render_seconds = 0.0
+        self.bytes = 0
+        self.buckets = [0] * len(BUCKETS)
+
+    def add(self, seconds, queries, query_seconds, render_seconds, size, error):
+        self.requests += 1
+        self.errors += error
+        self.seconds += seconds
+        self.queries += queries
+        self.query_seconds += query_seconds
+        self.render_seconds += render_seconds
+        self.bytes += size
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+
+
+class Registry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.views = {}
+
+    def record(self, view, **values):
+        with self.lock:
+            self.views.setdefault(view, ViewStats()).add(**values)
+
+    def reset(self):
+        with self.lock:
+            self.views = {}
+
+    def render(self):
+        """All counters in the Prometheus text exposition format"""
+        with self.lock:
+            views = sorted(self.views.items())
+            lines = []
+            for name, attribute, help_text in (
+                    ('chemdata_requests_total', 'requests', 'Requests handled'),
+                    ('chemdata_request_errors_total', 'errors', 'Responses with status 500 or above'),
+                    ('chemdata_sql_queries_total', 'queries', 'SQL queries executed'),
+                    ('chemdata_sql_seconds_total', 'query_seconds', 'Time spent in SQL queries'),
+                    ('chemdata_render_seconds_total', 'render_seconds', 'Time spent rendering templates'),
+                    ('chemdata_response_bytes_total', 'bytes', 'Response bytes sent')):
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+                lines += [f'{name}{{view="{view}"}} {getattr(stats, attribute):g}' for view, stats in views]
+            name = 'chemdata_request_seconds'
+            lines += [f'# HELP {name} Request duration', f'# TYPE {name} histogram']
+            for view, stats in views:
+                cumulative = 0
+                for bound, count in zip(BUCKETS, stats.buckets):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{view="{view}",le="{bound:g}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{view="{view}",le="+Inf"}} {stats.requests}')
+                lines.append(f'{name}_sum{{view="{view}"}} {stats.seconds:g}')
+                lines.append(f'{name}_count{{view="{view}"}} {stats.requests}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def _view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unresolved'
+    return match.view_name or match._func_path
+
+
+class RequestMetricsMiddleware:
+    # Both, so async views are not pushed onto a thread under ASGI
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        recorder = QueryRecorder()
+        request._metrics_render = [None, 0.0]
+        start = time.perf_counter()
+        with _recording(recorder):
+            response = self.get_response(request)
+        return self._finish(request, response, recorder, start)
+
+    async def __acall__(self, request):
+        recorder = QueryRecorder()
+        request._metrics_render = [None, 0.0]
+        start = time.perf_counter()
+        with _recording(recorder):
+            response = await self.get_response(request)
+        return self._finish(request, response, recorder, start)
+
+    def _finish(self, request, response, recorder, start):
+        seconds = time.perf_counter() - start
+        view = _view_name(request)
+        if response.streaming:
+            # Counted while the body is sent, the request is recorded when it is done
+            count = self._acount_stream if response.is_async else self._count_stream
+            response.streaming_content = count(response.streaming_content, request, view, start, recorder,
+                                               response.status_code)
+        else:
+            self._record(request, view, seconds, recorder, len(response.content), response.status_code)
+        return response
+
+    def process_template_response(self, request, response):
+        """Called right before rendering, the post render callback stops the clock"""
+        render = request._metrics_render
+
+        def stop(rendered):
+            render[1] += time.perf_counter() - render[0]
+
+        render[0] = time.perf_counter()
+        response.add_post_render_callback(stop)
+        return response
+
+    def _count_stream(self, content, request, view, start, recorder, status):
+        size = 0
+        with _recording(recorder):
+            for chunk in content:
+                size += len(chunk)
+                yield chunk
+        self._record(request, view, time.perf_counter() - start, recorder, size, status)
+
+    async def _acount_stream(self, content, request, view, start, recorder, status):
+        size = 0
+        with _recording(recorder):
+            async for chunk in content:
+                size += len(chunk)
+                yield chunk
+        self._record(request, view, time.perf_counter() - start, recorder, size, status)
+
+    def _record(self, request, view, seconds, recorder, size, status):
+        render_seconds = request._metrics_render[1]
+        registry.record(view, seconds=seconds, queries=recorder.count, query_seconds=recorder.seconds,
+                        render_seconds=render_seconds, size=size, error=status >= 500)
+        if seconds >= getattr(settings, 'METRICS_SLOW_REQUEST_SECONDS', 1.0):
+            slowest = '\n'.join(f'  {duration * 1000:.1f} ms: {sql}'
+                                for duration, _, sql in sorted(recorder.slowest, reverse=True))
+            logger.warning('Slow request %s %s (%s): %.0f ms, %d queries in %.0f ms, render %.0f ms, %d bytes\n%s',
+                           request.method, request.path, view, seconds * 1000, recorder.count,
+                           recorder.seconds * 1000, render_seconds * 1000, size, slowest)
+
+
+def record_query(execute, sql, params, many, context):
+    """Execute wrapper of every connection, passes the query on to the recorder of the current context"""
+    recorder = current_recorder.get()
+    if recorder is None:
+        return execute(sql, params, many, context)
+    return recorder(execute, sql, params, many, context)
+
+
+@receiver(connection_created)
+def install_wrapper(sender, connection, **kwargs):
+    # Called again when a persistent connection is reopened
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, record_query)
+
+
+@contextmanager
+def _recording(recorder):
+    """Queries of the block, in this thread or any thread started from it, go to recorder"""
+    token = current_recorder.set(recorder)
+    try:
+        yield
+    finally:
+        current_recorder.reset(token)
@@ -0,0 +1,13 @@
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.functional import SimpleLazyObject
+from django_user_agents.utils import get_user_agent
+
+
+class UserAgentMiddleware(MiddlewareMixin):
+    """
+    request.user_agent like django_user_agents.middleware.UserAgentMiddleware, which is sync only and would run every
+    async view in a thread of its own under ASGI
+    """
+
+    def process_request(self, request):
+        request.user_agent = SimpleLazyObject(lambda: get_user_agent(request))
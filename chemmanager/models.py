@@ -1,4 +1,5 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F, Q, Sum
 from django.contrib.auth.models import User
 from django.utils import timezone
 from django.urls import reverse
@@ -6,7 +7,9 @@ from users.models import Workgroup
 from treebeard.mp_tree import MP_Node
 from django.utils.safestring import mark_safe
 from django.utils import timezone
-from PIL import Image
+from .images import content_address, thumbnail_url
+from . import fragments
+from .units import unit_factor
 
 
 # soft delete: https://blog.usebutton.com/cascading-soft-deletion-in-django
@@ -57,6 +60,10 @@ class SoftDeleteModel(models.Model):
         self.deleted_at = None
         self.save()
 
+    class Meta:
+        # Own table per model: no join for deleted_at and bulk_create works
+        abstract = True
+
 
 class Distributor(models.Model):
     name = models.CharField(max_length=100)
@@ -79,6 +86,7 @@ class Chemical(models.Model):
     cid = models.CharField(max_length=100, blank=True, null=True)
     cas = models.CharField(max_length=100, blank=True, null=True)
     image = models.ImageField(upload_to='chemical_pics', blank=True, null=True)
+    THUMBNAIL_SIZE = 250
 
     secret = models.BooleanField(blank=True, null=True)
 
@@ -99,16 +107,21 @@ class Chemical(models.Model):
     def test_func_1(self):
         return self.stock_set.first().name
 
+    @property
+    def thumbnail_url(self):
+        return thumbnail_url(self.image, self.THUMBNAIL_SIZE)
+
     def save(self, *args, **kwargs):
+        # Only a new upload is hashed and stored, the thumbnail is made by a job (see signals)
+        self._image_changed = content_address(self.image)
         super().save(*args, **kwargs)
-        try:
-            with Image.open(self.image.path) as img:
-                if img.height > 250 or img.width > 250:
-                    output_size = (250, 250)
-                    img.thumbnail(output_size)
-                    img.save(self.image.path)
-        except ValueError:
-            print('No Image found')
+
+    class Meta:
+        indexes = [
+            # The chemical list and the keyset API page a workgroup by (name, id)
+            models.Index(fields=['workgroup', 'name']),
+            models.Index(fields=['cas']),
+        ]
 
 
 class Unit(models.Model):
@@ -129,34 +142,61 @@ class Storage(MP_Node):
     shared_workgroups = models.ManyToManyField(Workgroup, blank=True)
     workgroup = models.ForeignKey(Workgroup, on_delete=models.CASCADE, related_name='storage_workgroup')
 
+    # Display path and concatenated abbreviation, denormalized along the materialized path
+    path_name = models.TextField(blank=True, null=True, editable=False)
+    path_abbr = models.CharField(max_length=250, blank=True, null=True, editable=False)
+
     node_order_by = ['name']
 
     def __unicode__(self):
         return f'Place: {self.name}'
 
+    def _build_paths(self, ancestors):
+        names = [ancestor.name for ancestor in ancestors]
+        if names:
+            self.path_name = names[0] + ' (' + ', '.join(names[1:] + [self.name]) + ')'
+        else:
+            self.path_name = self.name
+        self.path_abbr = ''.join(str(node.abbreviation) for node in ancestors + [self] if node.abbreviation)
+
+    def refresh_paths(self):
+        """Recompute path_name and path_abbr of this node and its whole subtree"""
+        nodes = {node.path: node for node in self.get_ancestors()}
+        changed = []
+        for node in [self] + list(self.get_descendants().order_by('path')):
+            nodes[node.path] = node
+            ancestors = [nodes[node.path[:end]] for end in range(self.steplen, len(node.path), self.steplen)]
+            old = (node.path_name, node.path_abbr)
+            node._build_paths(ancestors)
+            if (node.path_name, node.path_abbr) != old:
+                changed.append(node)
+        Storage.objects.bulk_update(changed, ['path_name', 'path_abbr'])
+
+    def save(self, *args, **kwargs):
+        old = (self.path_name, self.path_abbr)
+        self._build_paths(list(self.get_ancestors()) if self.get_depth() > 1 else [])
+        super().save(*args, **kwargs)
+        if old != (self.path_name, self.path_abbr) and not self.is_leaf():
+            self.refresh_paths()
+
+    def move(self, target, pos=None):
+        super().move(target, pos)
+        # treebeard rewrites the paths with raw updates, so the stored names are rebuilt from the new tree
+        Storage.objects.get(pk=self.pk).refresh_paths()
+        fragments.invalidate()
+
     @property
     def location_name(self):
         '''Display Name like Place A (Subplace B, detailed Place C) in ListView'''
-        if self.get_depth() > 1:
-            name_str = self.get_root().name + ' ('
-            for parent in self.get_ancestors()[1:]:
-                name_str += f'{parent.name}, '
-            name_str += f'{self.name})'
-            return name_str
-        else:
-            return self.name
+        if self.path_name is None:
+            self._build_paths(list(self.get_ancestors()))
+        return self.path_name
 
     @property
     def full_abbr(self):
-        my_abbr = ''
-        for ancestor in self.get_ancestors():
-            if ancestor.abbreviation is None:
-                pass
-            else:
-                my_abbr += str(ancestor.abbreviation)
-        if self.abbreviation:
-            my_abbr += self.abbreviation
-        return my_abbr
+        if self.path_abbr is None:
+            self._build_paths(list(self.get_ancestors()))
+        return self.path_abbr
 
     def __str__(self):
         if self.shared_workgroups.count() > 0:
@@ -168,6 +208,10 @@ class Storage(MP_Node):
             # Intended to show Tree-View like behaviour
             return mark_safe(str)
 
+    class Meta:
+        # Storages are looked up by name within a workgroup, e.g. by the inventory import
+        indexes = [models.Index(fields=['workgroup', 'name'])]
+
 
 class Stock(SoftDeleteModel):
     # name = models.CharField(max_length=250)
@@ -186,42 +230,63 @@ class Stock(SoftDeleteModel):
     storage = models.ForeignKey(Storage, on_delete=models.CASCADE, )
     unit = models.ForeignKey(Unit, on_delete=models.CASCADE)
 
+    # Materialized balance, booked by Extraction.save/delete (see ``manage.py sync_stock_quantities``)
+    remaining_quantity = models.FloatField(blank=True, null=True, editable=False)
+
     @property
     def left_quantity(self):
         if self.unit:
-            left_quantity = self.quantity
-            for extraction in self.extraction_set.all():
-                left_quantity -= self.unit_converter(extraction)
-
-            return left_quantity
+            if self.remaining_quantity is None:
+                return self.quantity - self.extracted_quantity()
+            return self.remaining_quantity
         else:
             'ERROR'
 
+    def extracted_quantity(self):
+        """Sum of all extractions in the unit of this stock, one grouped query instead of one row per extraction"""
+        totals = self.extraction_set.order_by().values('unit').annotate(total=Sum('quantity'))
+        return sum(self.convert_quantity(row['total'], row['unit']) for row in totals)
+
+    def book_extraction(self, quantity, unit):
+        """Subtract an extraction from the stored balance. Negative quantities give it back."""
+        amount = self.convert_quantity(quantity, unit)
+        Stock.objects_with_deleted.filter(pk=self.pk).update(remaining_quantity=F('remaining_quantity') - amount)
+        if self.remaining_quantity is not None:
+            self.remaining_quantity -= amount
+
     def unit_converter(self, extraction):
+        return self.convert_quantity(extraction.quantity, extraction.unit_id)
+
+    def convert_quantity(self, quantity, unit):
         """
-        Check unit and compare with Stock Unit, if different, try to convert:
+        Convert a quantity given in unit (Unit, pk or name) into the unit of this stock, 0 if not convertible
         """
-        # Has to be written twice, can otherwise not be imported
-        unit = extraction.unit
-        stock_unit = self.unit
-        if unit == stock_unit:
-            return extraction.quantity
-        else:
-            fact = 1
-            if stock_unit != stock_unit.equals_standard_unit:
-                fact /= stock_unit.equals_standard
-                stock_unit = stock_unit.equals_standard_unit
+        factor = unit_factor(unit, self.unit_id)
+        if factor is None:
+            return 0
+        return quantity * factor
 
-            if unit.equals_standard_unit == stock_unit:
-                return extraction.quantity * unit.equals_standard * fact
-            else:
-                return 0
+    def save(self, *args, **kwargs):
+        # Quantity or unit may have changed, so the balance is rebuilt from the extraction history
+        if self.pk is None:
+            self.remaining_quantity = self.quantity
+        else:
+            self.remaining_quantity = self.quantity - self.extracted_quantity()
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return 'Stock'
 
     class Meta:
         ordering = ['-date_changed']
+        indexes = [
+            # Live stocks only, in the order they are listed; soft deleted rows do not grow these
+            models.Index(fields=['chemical', '-date_changed'], condition=Q(deleted_at=None),
+                         name='stock_live_chemical_idx'),
+            models.Index(fields=['storage'], condition=Q(deleted_at=None), name='stock_live_storage_idx'),
+            # Candidates for archive_stocks
+            models.Index(fields=['deleted_at'], condition=Q(deleted_at__isnull=False), name='stock_deleted_idx'),
+        ]
 
     def get_absolute_url(self):
         url = reverse('chemical-list', kwargs={'pk': self.chemical.pk}) + '?q=' + self.chemical.name
@@ -233,7 +298,7 @@ class Stock(SoftDeleteModel):
         # Remove prepopulated entries
         required_fields = [x for x in required_fields if
                            x not in ['unit', 'date_created', 'storage', 'id', 'softdeletemodel_ptr', 'deleted_at',
-                                     'extraction']]
+                                     'extraction', 'consumption']]
         return required_fields
 
 
@@ -251,8 +316,27 @@ class Extraction(models.Model):
         url = reverse('chemmanager-home') + '?q=' + self.stock.chemical.name
         return url
 
+    def save(self, *args, **kwargs):
+        """Book the extraction on the stock balance in the same transaction"""
+        with transaction.atomic():
+            if self.pk is not None:
+                previous = Extraction.objects.select_related('stock').filter(pk=self.pk).first()
+                if previous is not None:
+                    stock = self.stock if previous.stock_id == self.stock_id else previous.stock
+                    stock.book_extraction(-previous.quantity, previous.unit_id)
+            super().save(*args, **kwargs)
+            self.stock.book_extraction(self.quantity, self.unit_id)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            self.stock.book_extraction(-self.quantity, self.unit_id)
+            fragments.bump([self.stock.chemical_id])
+            return super().delete(*args, **kwargs)
+
     class Meta:
         ordering = ['-date_created']
+        # History of a stock in display order
+        indexes = [models.Index(fields=['stock', '-date_created'])]
 
 
 class ChemicalList(models.Model):
@@ -260,9 +344,165 @@ class ChemicalList(models.Model):
     file = models.FileField(upload_to='csv')
 
 
+class Job(models.Model):
+    """Work done outside the request by ``manage.py run_jobs``, see chemmanager.jobs"""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    kind = models.CharField(max_length=50)
+    arguments = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    progress = models.IntegerField(default=0)
+    total = models.IntegerField(blank=True, null=True)
+    message = models.TextField(blank=True)
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, blank=True, null=True)
+    date_created = models.DateTimeField(default=timezone.now)
+    date_started = models.DateTimeField(blank=True, null=True)
+    date_finished = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f'{self.kind} ({self.status})'
+
+    def get_absolute_url(self):
+        return reverse('job-detail', kwargs={'pk': self.pk})
+
+    def set_progress(self, progress, total=None):
+        self.progress = progress
+        if total is not None:
+            self.total = total
+        Job.objects.filter(pk=self.pk).update(progress=self.progress, total=self.total)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'date_created'])]
+
+
 class ChemicalSynonym(models.Model):
-    name = models.CharField(max_length=250)
+    name = models.CharField(max_length=250, db_index=True)
     chemical = models.ForeignKey(Chemical, on_delete=models.CASCADE)
+    # search.synonym_key of the name, set on save (bulk_create callers set it themselves)
+    normalized_name = models.CharField(max_length=250, db_index=True, blank=True, editable=False)
 
     def __str__(self):
         return self.name
+
+    def save(self, *args, **kwargs):
+        from .search import synonym_key
+        self.normalized_name = synonym_key(self.name)
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        # No delete signals (see chemmanager.signals), so update_chemical_synonyms can delete in bulk
+        from . import typeahead
+        workgroup = Chemical.objects.filter(pk=self.chemical_id).values_list('workgroup', flat=True).first()
+        result = super().delete(*args, **kwargs)
+        typeahead.invalidate(workgroup)
+        fragments.bump([self.chemical_id])
+        return result
+
+
+class ChemicalSearchEntry(models.Model):
+    """One searchable term (name, synonym or CAS) of a chemical, maintained by chemmanager.search"""
+    NAME = 'name'
+    SYNONYM = 'synonym'
+    CAS = 'cas'
+    KIND_CHOICES = [(NAME, 'Name'), (SYNONYM, 'Synonym'), (CAS, 'CAS')]
+
+    chemical = models.ForeignKey(Chemical, on_delete=models.CASCADE)
+    synonym = models.ForeignKey(ChemicalSynonym, on_delete=models.CASCADE, blank=True, null=True)
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    term = models.CharField(max_length=250, db_index=True)
+
+    def __str__(self):
+        return self.term
+
+
+class SearchTrigram(models.Model):
+    entry = models.ForeignKey(ChemicalSearchEntry, on_delete=models.CASCADE)
+    trigram = models.CharField(max_length=3)
+
+    class Meta:
+        indexes = [models.Index(fields=['trigram', 'entry'])]
+
+
+class PubChemCompound(models.Model):
+    """Cached PubChem lookup by normalized name and/or CID, found=False remembers misses (see chemmanager.pubchem)"""
+    name = models.CharField(max_length=250, unique=True, blank=True, null=True)
+    cid = models.IntegerField(blank=True, null=True, db_index=True)
+    found = models.BooleanField(default=True)
+    molecular_formula = models.CharField(max_length=100, blank=True, null=True)
+    molecular_weight = models.FloatField(blank=True, null=True)
+    date_fetched = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f'{self.name or self.cid} ({"found" if self.found else "not found"})'
+
+
+class StockConsumption(models.Model):
+    """
+    Consumption rate of a live stock and its forecast depletion, precomputed by chemmanager.analytics (see
+    ``manage.py refresh_consumption``). rate (per day) and remaining are in the canonical unit of the stock's unit.
+    """
+    stock = models.OneToOneField(Stock, on_delete=models.CASCADE, primary_key=True, related_name='consumption')
+    chemical = models.ForeignKey(Chemical, on_delete=models.CASCADE, related_name='+')
+    unit = models.ForeignKey(Unit, on_delete=models.CASCADE, related_name='+')
+    rate = models.FloatField(default=0)
+    remaining = models.FloatField(blank=True, null=True)
+    depletion_date = models.DateField(blank=True, null=True)
+    # The extraction history the row was computed from, a refresh skips stocks where both are unchanged
+    extraction_count = models.IntegerField(default=0)
+    last_extraction_id = models.IntegerField(blank=True, null=True)
+    date_computed = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [models.Index(fields=['chemical'])]
+
+
+class ChemicalConsumption(models.Model):
+    """Sum of the StockConsumption rows of a chemical per canonical unit, what the consumption dashboard lists"""
+    chemical = models.ForeignKey(Chemical, on_delete=models.CASCADE, related_name='consumption')
+    unit = models.ForeignKey(Unit, on_delete=models.CASCADE, related_name='+')
+    rate = models.FloatField(default=0)
+    remaining = models.FloatField(blank=True, null=True)
+    depletion_date = models.DateField(blank=True, null=True)
+    stocks = models.IntegerField(default=0)
+    date_computed = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = [('chemical', 'unit')]
+        indexes = [models.Index(fields=['depletion_date'])]
+
+
+class ArchivedStock(models.Model):
+    """Stock soft deleted long ago, moved out of the live table by chemmanager.archive (same id as before)"""
+    id = models.IntegerField(primary_key=True)
+    distributor = models.ForeignKey(Distributor, on_delete=models.CASCADE, blank=True, null=True, related_name='+')
+    price = models.FloatField(blank=True, null=True)
+    quantity = models.FloatField()
+    purity = models.CharField(max_length=20, blank=True, null=True)
+    comment = models.TextField(blank=True, null=True)
+    date_created = models.DateTimeField()
+    date_changed = models.DateTimeField()
+    label = models.CharField(max_length=10, blank=True, null=True)
+    chemical = models.ForeignKey(Chemical, on_delete=models.CASCADE, related_name='+')
+    storage = models.ForeignKey(Storage, on_delete=models.CASCADE, related_name='+')
+    unit = models.ForeignKey(Unit, on_delete=models.CASCADE, related_name='+')
+    remaining_quantity = models.FloatField(blank=True, null=True)
+    deleted_at = models.DateTimeField()
+    date_archived = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return 'Archived stock'
+
+
+class ArchivedExtraction(models.Model):
+    id = models.IntegerField(primary_key=True)
+    quantity = models.FloatField()
+    date_created = models.DateTimeField()
+    comment = models.TextField(blank=True, null=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, blank=True, null=True, related_name='+')
+    stock = models.ForeignKey(ArchivedStock, on_delete=models.CASCADE)
+    unit = models.ForeignKey(Unit, on_delete=models.CASCADE, related_name='+')
@@ -0,0 +1,45 @@
+"""
+Keyset (cursor) pagination on (name, id).
+
+A page continues strictly after the last row of the previous one, which the (name, id) index finds directly, so deep
+pages cost the same as the first one and no COUNT is needed to page. The cursor handed to clients is opaque.
+"""
+import base64
+import binascii
+import json
+from django.db.models import Q
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(name, pk):
+    return base64.urlsafe_b64encode(json.dumps([name, pk]).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        name, pk = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError) as error:
+        raise InvalidCursor(f'Invalid cursor "{cursor}"') from error
+    if not isinstance(name, str) or not isinstance(pk, int):
+        raise InvalidCursor(f'Invalid cursor "{cursor}"')
+    return name, pk
+
+
+def keyset_page(queryset, cursor=None, limit=100):
+    """
+    One page of queryset ordered by (name, id) after the cursor (None for the first page).
+    Returns the rows and the cursor of the next page, None on the last page.
+    """
+    queryset = queryset.order_by('name', 'pk')
+    if cursor:
+        name, pk = decode_cursor(cursor)
+        queryset = queryset.filter(Q(name__gt=name) | Q(name=name, pk__gt=pk))
+    # One row more than needed tells whether there is a next page
+    rows = list(queryset[:limit + 1])
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1].name, rows[-1].pk)
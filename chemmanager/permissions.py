@@ -0,0 +1,78 @@
+"""
+Per-request access control.
+
+AccessSnapshot answers the permission questions of the write views from the users workgroup and the ids of the
+storages it owns or that are shared with it, each loaded at most once per request. Objects passed in are expected to
+come with their relations (see AccessSnapshotMixin.get_object), so a check needs no query of its own.
+"""
+from django.utils.functional import cached_property
+from .models import Storage
+
+
+class AccessSnapshot:
+
+    def __init__(self, user):
+        self.user = user
+        self.workgroup_id = user.profile.workgroup_id
+
+    @cached_property
+    def owned_storages(self):
+        return set(Storage.objects.filter(workgroup_id=self.workgroup_id).values_list('pk', flat=True))
+
+    @cached_property
+    def shared_storages(self):
+        return set(Storage.objects.filter(shared_workgroups=self.workgroup_id).values_list('pk', flat=True))
+
+    def is_creator(self, obj):
+        return obj.creator_id is not None and obj.creator_id == self.user.pk
+
+    def in_workgroup(self, chemical):
+        return chemical.workgroup_id == self.workgroup_id
+
+    def can_add_stock(self, chemical):
+        """Only workgroup members edit stocks, shared groups may only extract (they could move storages otherwise)"""
+        return chemical is not None and self.in_workgroup(chemical)
+
+    def can_edit_stock(self, stock):
+        return self.in_workgroup(stock.chemical)
+
+    def can_remove_stock(self, stock):
+        return stock.storage_id in self.owned_storages
+
+    def can_extract(self, stock):
+        """Own chemicals and those in storages shared with the workgroup, unless they are secret"""
+        if self.in_workgroup(stock.chemical):
+            return True
+        return stock.storage_id in self.shared_storages and not stock.chemical.secret
+
+
+def get_access(request):
+    """The snapshot of the current request, created on first use"""
+    if not hasattr(request, '_access_snapshot'):
+        request._access_snapshot = AccessSnapshot(request.user)
+    return request._access_snapshot
+
+
+class AccessSnapshotMixin:
+    """
+    For views with UserPassesTestMixin: self.access is the request's AccessSnapshot and get_object is fetched once
+    per request (with related_objects joined), instead of again in test_func, get_form, get_context_data, form_valid.
+    """
+    related_objects = ()
+
+    @property
+    def access(self):
+        return get_access(self.request)
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.related_objects:
+            queryset = queryset.select_related(*self.related_objects)
+        return queryset
+
+    def get_object(self, queryset=None):
+        if queryset is not None:
+            return super().get_object(queryset)
+        if not hasattr(self, '_object'):
+            self._object = super().get_object()
+        return self._object
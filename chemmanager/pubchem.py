@@ -0,0 +1,336 @@
+"""
+Persistent cache in front of PubChem.
+
+Lookups by name or CID are answered from PubChemCompound rows while they are younger than PUBCHEM_CACHE_DAYS; misses
+are cached as found=False for PUBCHEM_NEGATIVE_CACHE_DAYS. Network access goes through a fetcher class configured with
+PUBCHEM_FETCHER, so tests and offline installs can use LocalFetcher instead of the live API. Async views use
+alookup_name with the fetcher configured as PUBCHEM_ASYNC_FETCHER, by default AsyncPubChemClient on httpx, which gives
+up after PUBCHEM_TIMEOUT seconds.
+"""
+import inspect
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from urllib.error import HTTPError, URLError
+from urllib.parse import quote
+from urllib.request import urlopen
+import httpx
+import pubchempy as pcp
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from .models import Chemical, PubChemCompound
+from .search import normalize
+
+logger = logging.getLogger(__name__)
+
+
+def compound_data(compound):
+    """The fields of a pubchempy Compound that are cached (everything generate_initial needs)"""
+    return {
+        'cid': compound.cid,
+        'molecular_formula': compound.molecular_formula,
+        'molecular_weight': compound.molecular_weight,
+    }
+
+
+class PubChemFetcher:
+    """Live PubChem API. Both methods return compound_data or None if PubChem does not know the compound."""
+
+    def by_name(self, name):
+        compounds = pcp.get_compounds(name, 'name')
+        return compound_data(compounds[0]) if compounds else None
+
+    def by_cid(self, cid):
+        try:
+            return compound_data(pcp.Compound.from_cid(cid))
+        except pcp.NotFoundError:
+            return None
+
+
+class LocalFetcher:
+    """
+    Stand-in for the API reading PUBCHEM_LOCAL_FILE, a JSON list of
+    {"cid": ..., "names": [...], "molecular_formula": ..., "molecular_weight": ...}
+    """
+
+    def __init__(self, compounds=None):
+        if compounds is None:
+            with open(settings.PUBCHEM_LOCAL_FILE) as file:
+                compounds = json.load(file)
+        self.by_names = {}
+        self.by_cids = {}
+        for compound in compounds:
+            data = {key: compound.get(key) for key in ('cid', 'molecular_formula', 'molecular_weight')}
+            self.by_cids[data['cid']] = data
+            for name in compound.get('names', []):
+                self.by_names[normalize(name)] = data
+
+    def by_name(self, name):
+        return self.by_names.get(normalize(name))
+
+    def by_cid(self, cid):
+        return self.by_cids.get(int(cid))
+
+
+class RateLimiter:
+    """Spaces calls from any number of threads at least 1 / per_second apart"""
+
+    def __init__(self, per_second):
+        self.interval = 1 / per_second if per_second else 0
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        time.sleep(max(0.0, slot - now))
+
+
+class PubChemRestClient:
+    """
+    Thin PUG REST client used for bulk work: shared rate limit, retries with exponential backoff on server errors and
+    timeouts, properties of many CIDs in one request. Also usable as PUBCHEM_FETCHER.
+    """
+    PROPERTIES = 'MolecularFormula,MolecularWeight'
+
+    def __init__(self, base_url=None, rate=5, retries=3, backoff=0.5, timeout=10):
+        self.base_url = (base_url or getattr(settings, 'PUBCHEM_API_URL',
+                                             'https://pubchem.ncbi.nlm.nih.gov/rest/pug')).rstrip('/')
+        self.limiter = RateLimiter(rate)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+    def _get(self, path):
+        """Decoded JSON response, None if PubChem does not know the record"""
+        for attempt in range(self.retries + 1):
+            self.limiter.wait()
+            try:
+                with urlopen(self.base_url + path, timeout=self.timeout) as response:
+                    return json.load(response)
+            except HTTPError as error:
+                # 400 is returned for names PubChem can not parse, that is a miss as well
+                if error.code in (400, 404):
+                    return None
+                if (error.code < 500 and error.code != 429) or attempt == self.retries:
+                    raise
+            except (URLError, TimeoutError):
+                if attempt == self.retries:
+                    raise
+            time.sleep(self.backoff * 2 ** attempt)
+
+    def cid_for_name(self, name):
+        data = self._get(f'/compound/name/{quote(name, safe="")}/cids/JSON')
+        cids = (data or {}).get('IdentifierList', {}).get('CID')
+        return cids[0] if cids else None
+
+    def properties(self, cids):
+        """{cid: compound_data} for all CIDs PubChem knows, one request"""
+        if not cids:
+            return {}
+        data = self._get(f'/compound/cid/{",".join(str(cid) for cid in cids)}/property/{self.PROPERTIES}/JSON')
+        rows = (data or {}).get('PropertyTable', {}).get('Properties', [])
+        return {row['CID']: {'cid': row['CID'],
+                             'molecular_formula': row.get('MolecularFormula'),
+                             'molecular_weight': float(row['MolecularWeight']) if row.get('MolecularWeight') else None}
+                for row in rows}
+
+    def synonyms(self, cids):
+        """{cid: [synonyms, most common first]} for all CIDs PubChem knows, one request"""
+        if not cids:
+            return {}
+        data = self._get(f'/compound/cid/{",".join(str(cid) for cid in cids)}/synonyms/JSON')
+        rows = (data or {}).get('InformationList', {}).get('Information', [])
+        return {row['CID']: row.get('Synonym', []) for row in rows}
+
+    def by_name(self, name):
+        cid = self.cid_for_name(name)
+        return self.properties([cid]).get(cid) if cid else None
+
+    def by_cid(self, cid):
+        return self.properties([int(cid)]).get(int(cid))
+
+
+class AsyncPubChemClient:
+    """
+    Non-blocking PUG REST client for the async views, one request per lookup. Network errors and timeouts
+    (httpx.HTTPError) are raised.
+    """
+    PROPERTIES = PubChemRestClient.PROPERTIES
+
+    def __init__(self, base_url=None, timeout=None, client=None):
+        self.base_url = (base_url or getattr(settings, 'PUBCHEM_API_URL',
+                                             'https://pubchem.ncbi.nlm.nih.gov/rest/pug')).rstrip('/')
+        self.timeout = timeout or getattr(settings, 'PUBCHEM_TIMEOUT', 5)
+        self.client = client
+
+    async def _properties(self, path):
+        if self.client is None:
+            async with httpx.AsyncClient(timeout=self.timeout) as client:
+                response = await client.get(self.base_url + path)
+        else:
+            response = await self.client.get(self.base_url + path, timeout=self.timeout)
+        # 400 is returned for names PubChem can not parse, that is a miss as well
+        if response.status_code in (400, 404):
+            return None
+        response.raise_for_status()
+        rows = response.json().get('PropertyTable', {}).get('Properties', [])
+        if not rows:
+            return None
+        return {'cid': rows[0]['CID'], 'molecular_formula': rows[0].get('MolecularFormula'),
+                'molecular_weight': float(rows[0]['MolecularWeight']) if rows[0].get('MolecularWeight') else None}
+
+    async def by_name(self, name):
+        return await self._properties(f'/compound/name/{quote(name, safe="")}/property/{self.PROPERTIES}/JSON')
+
+    async def by_cid(self, cid):
+        return await self._properties(f'/compound/cid/{int(cid)}/property/{self.PROPERTIES}/JSON')
+
+
+def get_fetcher():
+    return import_string(getattr(settings, 'PUBCHEM_FETCHER', 'chemmanager.pubchem.PubChemFetcher'))()
+
+
+def get_async_fetcher():
+    return import_string(getattr(settings, 'PUBCHEM_ASYNC_FETCHER', 'chemmanager.pubchem.AsyncPubChemClient'))()
+
+
+def is_fresh(entry):
+    days = getattr(settings, 'PUBCHEM_CACHE_DAYS', 30) if entry.found \
+        else getattr(settings, 'PUBCHEM_NEGATIVE_CACHE_DAYS', 1)
+    return entry.date_fetched > timezone.now() - timedelta(days=days)
+
+
+def _defaults(lookup, data):
+    defaults = {'found': data is not None, 'date_fetched': timezone.now(), 'cid': None,
+                'molecular_formula': None, 'molecular_weight': None}
+    defaults.update(data or {})
+    if 'cid' in lookup:
+        # A miss by CID keeps its CID so it can be found again
+        defaults['cid'] = lookup['cid']
+    return defaults
+
+
+def _store(lookup, data):
+    entry, _ = PubChemCompound.objects.update_or_create(defaults=_defaults(lookup, data), **lookup)
+    return entry
+
+
+def lookup_name(name, fetcher=None):
+    """Cached compound for a chemical name, None if PubChem does not know it. Network errors are raised."""
+    key = normalize(name)
+    entry = PubChemCompound.objects.filter(name=key).first()
+    if entry is None or not is_fresh(entry):
+        entry = _store({'name': key}, (fetcher or get_fetcher()).by_name(name))
+    return entry if entry.found else None
+
+
+def lookup_cid(cid, fetcher=None):
+    cid = int(cid)
+    entry = PubChemCompound.objects.filter(cid=cid).order_by('-found', '-date_fetched').first()
+    if entry is None or not is_fresh(entry):
+        entry = _store({'name': None, 'cid': cid}, (fetcher or get_fetcher()).by_cid(cid))
+    return entry if entry.found else None
+
+
+async def alookup_name(name, fetcher=None):
+    """lookup_name for async views, sync fetchers (e.g. LocalFetcher) are run in a worker thread"""
+    key = normalize(name)
+    entry = await PubChemCompound.objects.filter(name=key).afirst()
+    if entry is None or not is_fresh(entry):
+        fetcher = fetcher or get_async_fetcher()
+        if inspect.iscoroutinefunction(fetcher.by_name):
+            data = await fetcher.by_name(name)
+        else:
+            data = await sync_to_async(fetcher.by_name, thread_sensitive=False)(name)
+        lookup = {'name': key}
+        entry, _ = await PubChemCompound.objects.aupdate_or_create(defaults=_defaults(lookup, data), **lookup)
+    return entry if entry.found else None
+
+
+def _guarded(function):
+    """Run function in a worker thread, errors are returned instead of stopping the whole pool"""
+    def call(argument):
+        try:
+            return function(argument), None
+        except Exception as error:
+            return None, error
+    return call
+
+
+def enrich_chemicals(chemicals, client=None, workers=4, batch_size=100):
+    """
+    Fill missing cid, structure and molar_mass of the given chemicals (queryset) from the cache or PubChem.
+
+    Names without a CID are resolved concurrently (PubChem has no batch lookup by name), properties are then fetched
+    for batch_size CIDs per request. Only the worker threads talk to the network, all database work happens here.
+    Returns counts of updated, not found and failed chemicals.
+    """
+    client = client or PubChemRestClient()
+    chemicals = list(chemicals.only('id', 'name', 'cid', 'structure', 'molar_mass'))
+    stats = {'updated': 0, 'not_found': 0, 'failed': 0}
+
+    # Name -> CID, fresh cache rows first
+    names = {normalize(chemical.name): chemical.name for chemical in chemicals if not chemical.cid}
+    cached = {entry.name: entry for entry in PubChemCompound.objects.filter(name__in=names) if is_fresh(entry)}
+    missing_names = [name for key, name in names.items() if key not in cached]
+    name_cids, failed_names = {}, set()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for name, (cid, error) in zip(missing_names, pool.map(_guarded(client.cid_for_name), missing_names)):
+            if error is not None:
+                logger.warning('PubChem lookup for %s failed: %s', name, error)
+                failed_names.add(normalize(name))
+            else:
+                name_cids[normalize(name)] = cid
+        for key, entry in cached.items():
+            name_cids[key] = entry.cid if entry.found else None
+
+        # CID -> properties, batched
+        cids = {int(chemical.cid) for chemical in chemicals if chemical.cid and str(chemical.cid).isdigit()}
+        cids.update(cid for cid in name_cids.values() if cid)
+        known = {entry.cid: entry for entry in PubChemCompound.objects.filter(cid__in=cids, found=True)
+                 if is_fresh(entry)}
+        compounds = {cid: {'cid': cid, 'molecular_formula': entry.molecular_formula,
+                           'molecular_weight': entry.molecular_weight} for cid, entry in known.items()}
+        missing_cids = sorted(cids - set(known))
+        batches = [missing_cids[i:i + batch_size] for i in range(0, len(missing_cids), batch_size)]
+        failed_cids = set()
+        for batch, (result, error) in zip(batches, pool.map(_guarded(client.properties), batches)):
+            if error is not None:
+                logger.warning('PubChem properties for %d CIDs failed: %s', len(batch), error)
+                failed_cids.update(batch)
+            else:
+                compounds.update(result)
+
+    # Cache what was fetched, misses included, but not what failed
+    fetched_names = {key: cid for key, cid in name_cids.items() if key not in cached and cid not in failed_cids}
+    now = timezone.now()
+    PubChemCompound.objects.filter(name__in=fetched_names).delete()
+    PubChemCompound.objects.filter(name=None, cid__in=missing_cids).delete()
+    PubChemCompound.objects.bulk_create(
+        [PubChemCompound(name=key, date_fetched=now, found=cid in compounds, **compounds.get(cid, {'cid': cid}))
+         for key, cid in fetched_names.items()] +
+        [PubChemCompound(name=None, date_fetched=now, **compounds[cid]) for cid in missing_cids if cid in compounds])
+
+    changed = []
+    for chemical in chemicals:
+        key = normalize(chemical.name)
+        cid = int(chemical.cid) if chemical.cid and str(chemical.cid).isdigit() else name_cids.get(key)
+        data = compounds.get(cid)
+        if data is None:
+            stats['failed' if key in failed_names or cid in failed_cids else 'not_found'] += 1
+            continue
+        chemical.cid = chemical.cid or str(cid)
+        chemical.structure = chemical.structure or data['molecular_formula']
+        chemical.molar_mass = chemical.molar_mass or data['molecular_weight']
+        changed.append(chemical)
+    Chemical.objects.bulk_update(changed, ['cid', 'structure', 'molar_mass'], batch_size=500)
+    stats['updated'] = len(changed)
+    return stats
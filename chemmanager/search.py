@@ -0,0 +1,144 @@
+"""
+Trigram search index over chemical names, synonyms and CAS numbers.
+
+Every term is stored normalized in ChemicalSearchEntry together with its trigrams in SearchTrigram. A query first
+narrows the entries to those containing all trigrams of the query (index lookup) and only then checks the substring
+on the few candidates, instead of scanning Chemical and joining ChemicalSynonym for every keystroke.
+"""
+import unicodedata
+from itertools import chain
+from django.db.models import Case, Count, Max, Q, Value, When
+from .models import Chemical, ChemicalSearchEntry, ChemicalSynonym, SearchTrigram
+
+NAME, SYNONYM, CAS = ChemicalSearchEntry.NAME, ChemicalSearchEntry.SYNONYM, ChemicalSearchEntry.CAS
+
+
+def normalize(value):
+    return ' '.join(str(value).casefold().split())
+
+
+def synonym_key(value):
+    """
+    What synonyms are told apart by (ChemicalSynonym.normalized_name): casefolded without whitespace and punctuation,
+    so "Propan-2-ol" and "propan 2 ol " are the same synonym
+    """
+    return ''.join(char for char in str(value).casefold()
+                   if not char.isspace() and not unicodedata.category(char).startswith('P'))
+
+
+def trigrams(term):
+    return {term[i:i + 3] for i in range(len(term) - 2)}
+
+
+def _store(entries, batch_size=2000):
+    entries = ChemicalSearchEntry.objects.bulk_create([entry for entry in entries if entry.term],
+                                                      batch_size=batch_size)
+    SearchTrigram.objects.bulk_create([SearchTrigram(entry=entry, trigram=trigram)
+                                       for entry in entries for trigram in trigrams(entry.term)],
+                                      batch_size=batch_size)
+
+
+def _chemical_entries(chemical):
+    entries = [ChemicalSearchEntry(chemical_id=chemical.pk, kind=NAME, term=normalize(chemical.name))]
+    if chemical.cas:
+        entries.append(ChemicalSearchEntry(chemical_id=chemical.pk, kind=CAS, term=normalize(chemical.cas)))
+    return entries
+
+
+def _synonym_entry(synonym):
+    return ChemicalSearchEntry(chemical_id=synonym.chemical_id, synonym_id=synonym.pk, kind=SYNONYM,
+                               term=normalize(synonym.name))
+
+
+def index_chemical(chemical):
+    """Reindex name and CAS of a chemical, synonyms keep their own entries"""
+    ChemicalSearchEntry.objects.filter(chemical=chemical, kind__in=[NAME, CAS]).delete()
+    _store(_chemical_entries(chemical))
+
+
+def index_chemicals(chemicals):
+    """Index freshly bulk created chemicals, which do not send post_save"""
+    _store([entry for chemical in chemicals for entry in _chemical_entries(chemical)])
+
+
+def index_synonym(synonym):
+    ChemicalSearchEntry.objects.filter(synonym=synonym).delete()
+    _store([_synonym_entry(synonym)])
+
+
+def index_synonyms(synonyms):
+    """Index freshly bulk created synonyms"""
+    _store([_synonym_entry(synonym) for synonym in synonyms])
+
+
+def rebuild_index(batch_size=2000):
+    """Drop and rebuild the whole index, returns the number of entries"""
+    ChemicalSearchEntry.objects.all().delete()
+    count = 0
+    batch = []
+    chemicals = Chemical.objects.only('id', 'name', 'cas').order_by('pk').iterator(chunk_size=batch_size)
+    synonyms = ChemicalSynonym.objects.only('id', 'name', 'chemical_id').order_by('pk').iterator(chunk_size=batch_size)
+    entries = chain((entry for chemical in chemicals for entry in _chemical_entries(chemical)),
+                    (_synonym_entry(synonym) for synonym in synonyms))
+    for entry in entries:
+        batch.append(entry)
+        if len(batch) >= batch_size:
+            _store(batch, batch_size)
+            count += len(batch)
+            batch = []
+    _store(batch, batch_size)
+    return count + len(batch)
+
+
+def normalize_synonyms(batch_size=2000):
+    """Fill ChemicalSynonym.normalized_name where it is outdated (e.g. synonyms stored before it existed)"""
+    changed = []
+    for synonym in ChemicalSynonym.objects.only('id', 'name', 'normalized_name').order_by('pk') \
+            .iterator(chunk_size=batch_size):
+        if synonym.normalized_name != synonym_key(synonym.name):
+            synonym.normalized_name = synonym_key(synonym.name)
+            changed.append(synonym)
+    ChemicalSynonym.objects.bulk_update(changed, ['normalized_name'], batch_size=batch_size)
+    return len(changed)
+
+
+def matching_entries(query):
+    """
+    Entries whose term contains the query (names, synonyms) or starts with it (CAS), and the synonyms equal to it but
+    for whitespace and punctuation (exact hits on ChemicalSynonym.normalized_name)
+    """
+    key = synonym_key(query)
+    query = normalize(query)
+    entries = ChemicalSearchEntry.objects.filter(Q(kind__in=[NAME, SYNONYM], term__contains=query) |
+                                                 Q(kind=CAS, term__startswith=query))
+    grams = trigrams(query)
+    if grams:
+        candidates = SearchTrigram.objects.filter(trigram__in=grams).values('entry') \
+            .annotate(hits=Count('pk')).filter(hits=len(grams)).values('entry')
+        entries = entries.filter(pk__in=candidates)
+    if key:
+        entries |= ChemicalSearchEntry.objects.filter(synonym__in=ChemicalSynonym.objects.filter(normalized_name=key))
+    return entries
+
+
+def ranked_chemicals(query, chemicals):
+    """
+    Rows {'chemical': pk} of the chemicals (a Chemical queryset, e.g. scoped to a workgroup) matching query, best match
+    first: exact before prefix before substring, names before synonyms and CAS.
+    """
+    normalized = normalize(query)
+    exact = [When(term=normalized, then=Value(4))]
+    if synonym_key(query):
+        exact.append(When(synonym__normalized_name=synonym_key(query), then=Value(4)))
+    score = Case(*exact, When(term__startswith=normalized, then=Value(2)),
+                 default=Value(1)) + Case(When(kind=NAME, then=Value(1)), default=Value(0))
+    return matching_entries(query).filter(chemical__in=chemicals.values('pk')).values('chemical') \
+        .annotate(score=Max(score)).order_by('-score', 'chemical__name')
+
+
+def search_chemicals(query, chemicals, limit=None):
+    """Primary keys of the chemicals matching query, best match first, see ranked_chemicals"""
+    ranked = ranked_chemicals(query, chemicals)
+    if limit is not None:
+        ranked = ranked[:limit]
+    return [row['chemical'] for row in ranked]
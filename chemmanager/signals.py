@@ -0,0 +1,95 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_save, post_delete
+from django.dispatch import receiver
+from .models import Chemical, ChemicalSynonym, Distributor, Extraction, Stock, Storage, Unit, Workgroup
+from . import directory, fragments, jobs, search, typeahead
+from .units import invalidate_unit_converter
+
+
+@receiver(post_save, sender=Unit)
+@receiver(post_delete, sender=Unit)
+def reset_unit_converter(sender, **kwargs):
+    invalidate_unit_converter()
+
+
+@receiver(post_save, sender=Chemical)
+def index_chemical(sender, instance, raw=False, **kwargs):
+    if not raw:
+        search.index_chemical(instance)
+
+
+@receiver(post_save, sender=Chemical)
+def make_thumbnail(sender, instance, raw=False, **kwargs):
+    if not raw and getattr(instance, '_image_changed', False):
+        name = instance.image.name
+        transaction.on_commit(lambda: jobs.enqueue('thumbnails', name=name, sizes=[Chemical.THUMBNAIL_SIZE]))
+
+
+@receiver(post_save, sender=ChemicalSynonym)
+def index_synonym(sender, instance, raw=False, **kwargs):
+    if not raw:
+        search.index_synonym(instance)
+
+
+@receiver(post_save, sender=Chemical)
+@receiver(post_delete, sender=Chemical)
+def reset_typeahead(sender, instance, **kwargs):
+    typeahead.invalidate(instance.workgroup_id)
+
+
+@receiver(post_save, sender=ChemicalSynonym)
+def reset_typeahead_synonym(sender, instance, **kwargs):
+    workgroup = Chemical.objects.filter(pk=instance.chemical_id).values_list('workgroup', flat=True).first()
+    typeahead.invalidate(workgroup)
+
+
+@receiver(m2m_changed, sender=Storage.shared_workgroups.through)
+@receiver(post_save, sender=Storage)
+@receiver(post_delete, sender=Storage)
+@receiver(post_save, sender=Workgroup)
+@receiver(post_delete, sender=Workgroup)
+def reset_directory(sender, **kwargs):
+    # m2m_changed is sent before and after each change, once is enough
+    if kwargs.get('action', 'post_').startswith('post_'):
+        directory.invalidate()
+
+
+def _bump_cards(chemical_id):
+    # Again after the commit, a card rendered from data read before it is not kept under the new stamp
+    fragments.bump([chemical_id])
+    transaction.on_commit(lambda: fragments.bump([chemical_id]))
+
+
+@receiver(post_save, sender=Chemical)
+@receiver(post_delete, sender=Chemical)
+def reset_card(sender, instance, **kwargs):
+    _bump_cards(instance.pk)
+
+
+# No delete receivers for stocks, extractions and synonyms, they would turn the queryset deletes of archive_stocks and
+# update_chemical_synonyms into row by row deletes. Stocks are soft deleted with a save, Extraction.delete and
+# ChemicalSynonym.delete reset what depends on them themselves. Chemical deletes are covered by the receivers above.
+@receiver(post_save, sender=Stock)
+@receiver(post_save, sender=ChemicalSynonym)
+def reset_card_of_chemical(sender, instance, **kwargs):
+    _bump_cards(instance.chemical_id)
+
+
+@receiver(post_save, sender=Extraction)
+def reset_card_of_stock(sender, instance, **kwargs):
+    _bump_cards(instance.stock.chemical_id)
+
+
+@receiver(m2m_changed, sender=Storage.shared_workgroups.through)
+@receiver(post_save, sender=Storage)
+@receiver(post_delete, sender=Storage)
+@receiver(post_save, sender=Workgroup)
+@receiver(post_delete, sender=Workgroup)
+@receiver(post_save, sender=Unit)
+@receiver(post_delete, sender=Unit)
+@receiver(post_save, sender=Distributor)
+@receiver(post_delete, sender=Distributor)
+def reset_cards(sender, **kwargs):
+    if kwargs.get('action', 'post_').startswith('post_'):
+        fragments.invalidate()
+        transaction.on_commit(fragments.invalidate)
@@ -0,0 +1,95 @@
+"""
+In-process prefix index for the type-ahead of the chemical search.
+
+Every workgroup gets a sorted array of normalized keys (names and synonyms, plus every word of them, so "chlor" finds
+"Sodium chloride") pointing to the chemical name. A completion is a binary search and a short scan, no database query.
+Indexes are built on first use, dropped by the Chemical/ChemicalSynonym signals (and by the synonym deletes and bulk
+writes, which send none) and rebuilt after TYPEAHEAD_MAX_AGE seconds at the latest, for changes made by other
+processes.
+"""
+import re
+import threading
+import time
+from bisect import bisect_left
+from django.conf import settings
+from .search import normalize
+
+WORD_START = re.compile(r'(?<=[\s\-,;/(\[])\S')
+
+
+def keys(term):
+    """The normalized term and its suffixes starting at a word"""
+    term = normalize(term)
+    if not term:
+        return []
+    return [term] + [term[match.start():] for match in WORD_START.finditer(term)]
+
+
+class PrefixIndex:
+
+    def __init__(self, pairs):
+        """pairs of (term, chemical name), the term being the name itself or a synonym"""
+        entries = sorted({(key, name) for term, name in pairs for key in keys(term)})
+        self.keys = [key for key, _ in entries]
+        self.names = [name for _, name in entries]
+        self.built = time.monotonic()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def complete(self, prefix, limit=10):
+        """Up to limit chemical names with a key starting with prefix, shortest (closest) keys first"""
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        # Bounded scan: only the first limit * 20 keys with the prefix are ranked, short prefixes stay fast
+        position = bisect_left(self.keys, prefix)
+        end = min(len(self.keys), position + limit * 20)
+        matches = []
+        while position < end and self.keys[position].startswith(prefix):
+            matches.append((len(self.keys[position]), self.keys[position], self.names[position]))
+            position += 1
+        names = []
+        for _, _, name in sorted(matches):
+            if name not in names:
+                names.append(name)
+                if len(names) == limit:
+                    break
+        return names
+
+
+_indexes = {}
+# Counts invalidations, an index built while one happened may be stale and is not kept
+_generation = 0
+_lock = threading.Lock()
+
+
+def get_index(workgroup_id):
+    """Process wide index of a workgroup, built once and reset by invalidate"""
+    index = _indexes.get(workgroup_id)
+    if index is None or time.monotonic() - index.built > getattr(settings, 'TYPEAHEAD_MAX_AGE', 60):
+        from .models import Chemical, ChemicalSynonym
+        generation = _generation
+        chemicals = Chemical.objects.filter(workgroup_id=workgroup_id)
+        pairs = [(name, name) for name in chemicals.values_list('name', flat=True)]
+        pairs += ChemicalSynonym.objects.filter(chemical__in=chemicals).values_list('name', 'chemical__name')
+        index = PrefixIndex(pairs)
+        with _lock:
+            if _generation == generation:
+                _indexes[workgroup_id] = index
+    return index
+
+
+def invalidate(workgroup_id=None):
+    """Drop the index of one workgroup, of all without argument"""
+    global _generation
+    with _lock:
+        _generation += 1
+        if workgroup_id is None:
+            _indexes.clear()
+        else:
+            _indexes.pop(workgroup_id, None)
+
+
+def complete(workgroup_id, prefix, limit=10):
+    return get_index(workgroup_id).complete(prefix, limit)
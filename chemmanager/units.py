@@ -0,0 +1,139 @@
+import numpy as np
+
+
+class UnitConverter:
+    """
+    Conversion factors between all units, precomputed from the Unit graph.
+
+    Every Unit points to a standard unit via equals_standard / equals_standard_unit. Units connected through these
+    edges (in any direction and over any number of hops) form one dimension; each unit stores its scale relative to
+    the root of that dimension, so the factor between two units is a single division.
+    """
+
+    def __init__(self, units):
+        units = list(units)
+        self.ids = np.array(sorted(unit.pk for unit in units), dtype=np.int64)
+        self.names = {unit.name: unit.pk for unit in units}
+        position = {pk: i for i, pk in enumerate(self.ids.tolist())}
+
+        edges = {pk: [] for pk in position}
+        for unit in units:
+            target = unit.equals_standard_unit_id
+            if target in position and target != unit.pk and unit.equals_standard:
+                # 1 unit = equals_standard target, edges hold scale(neighbour) / scale(current)
+                edges[unit.pk].append((target, 1 / unit.equals_standard))
+                edges[target].append((unit.pk, unit.equals_standard))
+
+        self.root = np.zeros(len(self.ids), dtype=np.int64)
+        self.scale = np.ones(len(self.ids), dtype=float)
+        seen = set()
+        for start in self.ids.tolist():
+            if start in seen:
+                continue
+            seen.add(start)
+            self.root[position[start]] = start
+            stack = [start]
+            while stack:
+                current = stack.pop()
+                for neighbour, factor in edges[current]:
+                    if neighbour not in seen:
+                        seen.add(neighbour)
+                        self.root[position[neighbour]] = start
+                        self.scale[position[neighbour]] = self.scale[position[current]] * factor
+                        stack.append(neighbour)
+
+    def _resolve(self, unit):
+        """Unit instance, primary key or name -> primary key"""
+        if isinstance(unit, str):
+            return self.names[unit]
+        return getattr(unit, 'pk', unit)
+
+    def _position(self, unit):
+        pk = self._resolve(unit)
+        i = int(np.searchsorted(self.ids, pk))
+        if i >= len(self.ids) or self.ids[i] != pk:
+            raise KeyError(unit)
+        return i
+
+    def _positions(self, units):
+        """Positions of an array of primary keys, KeyError if one is not known"""
+        pks = np.asarray(units, dtype=np.int64)
+        positions = np.searchsorted(self.ids, pks)
+        if np.any(positions >= len(self.ids)) or np.any(self.ids[np.minimum(positions, len(self.ids) - 1)] != pks):
+            raise KeyError(units)
+        return positions
+
+    def unit_id(self, unit):
+        """Primary key of a unit given as instance, primary key or name, KeyError if there is no such unit"""
+        return int(self.ids[self._position(unit)])
+
+    def factor(self, from_unit, to_unit):
+        """Factor to convert from_unit into to_unit, None if they measure different things"""
+        i, j = self._position(from_unit), self._position(to_unit)
+        if self.root[i] != self.root[j]:
+            return None
+        return float(self.scale[i] / self.scale[j])
+
+    def convert(self, quantity, from_unit, to_unit):
+        """
+        Convert quantity from from_unit into to_unit. quantity and from_unit may be NumPy arrays (from_unit as
+        primary keys), so a whole column converts in one call. Incompatible units give NaN.
+        """
+        j = self._position(to_unit)
+        if np.ndim(from_unit) == 0:
+            factor = self.factor(from_unit, to_unit)
+            if factor is None:
+                factor = np.nan
+            return quantity * factor if np.ndim(quantity) == 0 else np.asarray(quantity, dtype=float) * factor
+
+        positions = self._positions(from_unit)
+        factors = np.where(self.root[positions] == self.root[j], self.scale[positions] / self.scale[j], np.nan)
+        return np.asarray(quantity, dtype=float) * factors
+
+    def canonical(self, units):
+        """
+        Canonical unit (the root of the dimension) and the factor into it for an array of unit primary keys, so
+        quantities measured in different but convertible units can be added up: quantity * factor in root.
+        """
+        positions = self._positions(units)
+        return self.root[positions], self.scale[positions]
+
+
+_converter = None
+
+
+def get_unit_converter(refresh=False):
+    """Process wide converter, built once from all units and reset by invalidate_unit_converter"""
+    global _converter
+    if _converter is None or refresh:
+        from .models import Unit
+        _converter = UnitConverter(Unit.objects.all())
+    return _converter
+
+
+def invalidate_unit_converter():
+    global _converter
+    _converter = None
+
+
+def convert_quantity(quantity, from_unit, to_unit):
+    """Convert with the cached converter, rebuilding it once if a unit is not known yet (e.g. created elsewhere)"""
+    try:
+        return get_unit_converter().convert(quantity, from_unit, to_unit)
+    except KeyError:
+        return get_unit_converter(refresh=True).convert(quantity, from_unit, to_unit)
+
+
+def unit_factor(from_unit, to_unit):
+    try:
+        return get_unit_converter().factor(from_unit, to_unit)
+    except KeyError:
+        return get_unit_converter(refresh=True).factor(from_unit, to_unit)
+
+
+def resolve_unit(unit):
+    """UnitConverter.unit_id with the cached converter, rebuilt once for units created elsewhere"""
+    try:
+        return get_unit_converter().unit_id(unit)
+    except KeyError:
+        return get_unit_converter(refresh=True).unit_id(unit)
@@ -7,6 +7,8 @@ from .views import (
     StockUpdateView,
     ChemicalDeleteView,
     ExtractionCreateView,
+    ExtractionBatchView,
+    ConsumptionView,
     StockDeleteView,
     StorageListView,
     StorageCreateView,
@@ -18,7 +20,14 @@ from .views import (
     ChemicalListUploadView,
     ChemicalListVerifyView,
     ChemicalTableView,
+    ChemicalExportView,
+    ChemicalApiView,
+    ChemicalTypeaheadView,
+    ChemicalSearchView,
+    PubChemLookupView,
     PostListView,
+    JobDetailView,
+    MetricsView,
 )
 from . import views
 
@@ -28,6 +37,11 @@ urlpatterns = [
     path('', login_required(ChemicalListView.as_view()), name='chemmanager-home'),
     path('<int:pk>/', ChemicalListView.as_view(), name='chemical-list'),
     path('chemical/all/', ChemicalTableView.as_view(), name='chemical-table'),
+    path('chemical/typeahead/', login_required(ChemicalTypeaheadView.as_view()), name='chemical-typeahead'),
+    path('chemical/search/', login_required(ChemicalSearchView.as_view()), name='chemical-search'),
+    path('pubchem/lookup/', login_required(PubChemLookupView.as_view()), name='pubchem-lookup'),
+    path('api/chemicals/', ChemicalApiView.as_view(), name='api-chemicals'),
+    path('chemical/export.<str:format>', ChemicalExportView.as_view(), name='chemical-export'),
     path('upload/chemicallist/<int:pk>/verify/', ChemicalListVerifyView.as_view(), name='chemicallist-verify'),
     path('upload/chemicallist/', ChemicalListUploadView.as_view(), name="chemicallist-upload"),
     path('chemical/<int:pk>/update', ChemicalUpdateView.as_view(), name='chemical-update'),
@@ -38,6 +52,8 @@ urlpatterns = [
     path('stock/<int:pk>/', login_required(StockUpdateView.as_view()), name='stock-update'),
     path('chemical/<int:pk>/delete', ChemicalDeleteView.as_view(), name='chemical-delete'),
     path('stock/<int:pk>/extraction/new', ExtractionCreateView.as_view(), name='extraction-create'),
+    path('extraction/batch/', ExtractionBatchView.as_view(), name='extraction-batch'),
+    path('consumption/', ConsumptionView.as_view(), name='consumption'),
     path('stock/<int:pk>/delete', StockDeleteView.as_view(), name='stock-delete'),
     path('storage/', StorageListView.as_view(), name='storage-list'),
     path('storage/<int:pk>/add/', StorageCreateView.as_view(), name='storage-create'),
@@ -46,5 +62,7 @@ urlpatterns = [
     path('chemical/<int:pk>/', ChemicalDetailView.as_view(), name='chemical-detail'),
     path('distributor-autocomplete/', DistributorAutocomplete.as_view(create_field='name'),
          name='distributor-autocomplete'),
+    path('job/<int:pk>/', JobDetailView.as_view(), name='job-detail'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
     path('search-parameter-autocomplete/', SearchParameterAutocomplete.as_view(), name='search-parameter-autocomplete'),
 ]
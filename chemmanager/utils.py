@@ -1,22 +1,26 @@
+import logging
 import pubchempy as pcp
-import os.path
-from .models import Stock, Unit, ChemicalSynonym, Chemical
+from django.db import transaction
+from .models import Stock, ChemicalSynonym, Chemical
+from .units import unit_factor
+from .pubchem import PubChemRestClient, lookup_name
+from .search import synonym_key
+from . import fragments, search, typeahead
+
+logger = logging.getLogger(__name__)
 
 
 class PubChemLoader:
     def __init__(self, chemical_name):
         self.chemical_name = chemical_name
+        # Cached lookup, compound has cid, molecular_formula and molecular_weight like a pubchempy Compound
         try:
-            self.compound = pcp.get_compounds(self.chemical_name, 'name')[0]
-        except IndexError:
-            print('Could not get any data')
+            self.compound = lookup_name(self.chemical_name)
+        except (pcp.PubChemPyError, OSError):
+            logger.exception('PubChem lookup for %s failed', self.chemical_name)
             self.compound = None
-
-    def load_img(self):
-        img_path = f'/chemical_pics/{self.compound.cid}.png'
-        if not os.path.isfile('./media' + img_path):
-            pcp.download('PNG', './media' + img_path, self.compound.cid, 'cid')
-        return img_path
+        if self.compound is None:
+            print('Could not get any data')
 
     def generate_initial(self, initial_dict):
         # initial_dict['name'] = self.compound.iupac_name
@@ -32,32 +36,113 @@ class PubChemLoader:
         return initial_dict
 
 
+def _apply_synonyms(added, removed, chemicals):
+    """
+    Write a synonym diff with one bulk_create and one queryset delete. Neither sends signals, so the search index,
+    type-ahead and chemical cards are updated here.
+    """
+    with transaction.atomic():
+        if removed:
+            ChemicalSynonym.objects.filter(pk__in=removed).delete()
+        search.index_synonyms(ChemicalSynonym.objects.bulk_create(added, batch_size=1000))
+    workgroups = {chemical.workgroup_id for chemical in chemicals}
+    chemical_ids = [chemical.pk for chemical in chemicals]
+
+    def reset():
+        for workgroup in workgroups:
+            typeahead.invalidate(workgroup)
+        fragments.bump(chemical_ids)
+    # Again after the commit, like the signals do, an index or card built from data read before it is dropped
+    reset()
+    transaction.on_commit(reset)
+
+
 def update_chemical_synonyms(chemical: Chemical, synonyms: list):
-    all_synonyms = ChemicalSynonym.objects.filter(chemical=chemical)
-    # Create those, which do not exist
-    for synonym in synonyms:
-        _, _ = ChemicalSynonym.objects.get_or_create(name=synonym, chemical=chemical)
-    # Remove those, which have been removed
-    for synonym in all_synonyms:
-        if synonym.name not in synonyms:
-            synonym.delete()
+    """
+    Make synonyms the synonyms of chemical with one set diff on search.synonym_key: a name that only differs in case,
+    whitespace or punctuation keeps the stored synonym, duplicates are dropped. Returns the numbers of added and
+    removed synonyms.
+    """
+    wanted = {}
+    for name in synonyms:
+        name = ' '.join(name.split())
+        if synonym_key(name):
+            wanted.setdefault(synonym_key(name), name)
+    kept, removed = set(), []
+    for pk, name in ChemicalSynonym.objects.filter(chemical=chemical).order_by('pk').values_list('pk', 'name'):
+        key = synonym_key(name)
+        if key in wanted and key not in kept:
+            kept.add(key)
+        else:
+            removed.append(pk)
+    added = [ChemicalSynonym(chemical=chemical, name=name, normalized_name=key)
+             for key, name in wanted.items() if key not in kept]
+    if added or removed:
+        _apply_synonyms(added, removed, [chemical])
+    return len(added), len(removed)
+
+
+def _fetch_synonyms(client, by_cid, batch_size, stats):
+    """{cid: synonyms} of the CIDs in by_cid, batch_size per request; chemicals of failed batches count in stats"""
+    cids = sorted(by_cid)
+    found = {}
+    for batch in (cids[i:i + batch_size] for i in range(0, len(cids), batch_size)):
+        try:
+            found.update(client.synonyms(batch))
+        except (OSError, ValueError) as error:
+            logger.warning('PubChem synonyms for %d CIDs failed: %s', len(batch), error)
+            stats['failed'] += sum(len(by_cid[cid]) for cid in batch)
+    return {cid: names for cid, names in found.items() if cid in by_cid}
+
+
+def _new_synonyms(found, by_cid, limit):
+    """Unsaved ChemicalSynonyms of the first limit names found per CID that their chemicals do not have yet"""
+    chemicals = [chemical for cid in found for chemical in by_cid[cid]]
+    known = {(chemical.pk, synonym_key(chemical.name)) for chemical in chemicals}
+    known.update((pk, synonym_key(name)) for pk, name in ChemicalSynonym.objects.filter(
+        chemical__in=[chemical.pk for chemical in chemicals]).values_list('chemical_id', 'name'))
+    added = []
+    for cid, names in found.items():
+        names = [' '.join(name.split())[:250] for name in names[:limit]]
+        for chemical in by_cid[cid]:
+            for name in names:
+                key = synonym_key(name)
+                if key and (chemical.pk, key) not in known:
+                    known.add((chemical.pk, key))
+                    added.append(ChemicalSynonym(chemical=chemical, name=name, normalized_name=key))
+    return added, chemicals
+
+
+def import_pubchem_synonyms(chemicals, client=None, limit=10, batch_size=100):
+    """
+    Add the limit most common PubChem synonyms to each of the chemicals (queryset) with a CID, fetched for batch_size
+    CIDs per request. Synonyms already known by synonym_key, and the chemical's own name, are skipped. Returns counts
+    of added synonyms and of chemicals whose CIDs failed.
+    """
+    by_cid = {}
+    for chemical in chemicals.only('id', 'name', 'cid', 'workgroup'):
+        if chemical.cid and str(chemical.cid).isdigit():
+            by_cid.setdefault(int(chemical.cid), []).append(chemical)
+    stats = {'added': 0, 'failed': 0}
+    if not by_cid:
+        return stats
+
+    found = _fetch_synonyms(client or PubChemRestClient(), by_cid, batch_size, stats)
+    added, chemicals = _new_synonyms(found, by_cid, limit)
+    if added:
+        _apply_synonyms(added, [], chemicals)
+    stats['added'] = len(added)
+    return stats
 
 
 def unit_converter(input_val, unit_name, stock: Stock):
     """
     Check unit and compare with Stock Unit, if different, try to convert:
     """
-    unit = Unit.objects.filter(name=unit_name).first()
-    stock_unit = stock.unit
-    if unit == stock_unit:
-        return input_val
-    else:
-        fact = 1
-        if stock_unit != stock_unit.equals_standard_unit:
-            fact /= stock_unit.equals_standard
-            stock_unit = stock_unit.equals_standard_unit
-
-        if unit.equals_standard_unit == stock_unit:
-            return input_val * unit.equals_standard * fact
-        else:
-            return False
+    try:
+        factor = unit_factor(unit_name, stock.unit_id)
+    except KeyError:
+        return False
+    if factor is None:
+        return False
+    return input_val * factor
@@ -1,19 +1,42 @@
-from django.views.generic import ListView, CreateView, UpdateView, DeleteView, DetailView
+import json
+import logging
+from datetime import timedelta
+import httpx
+import pubchempy as pcp
+from asgiref.sync import sync_to_async
+from django.views.generic import ListView, CreateView, UpdateView, DeleteView, DetailView, View
 from django.contrib.auth.mixins import UserPassesTestMixin, LoginRequiredMixin
 from django.urls import reverse_lazy, reverse
-from django.http import HttpResponseRedirect
+from django.utils import timezone
+from django.utils.functional import cached_property
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, HttpResponse, HttpResponseRedirect, StreamingHttpResponse
 from django.contrib import messages
-from django.db.models import Count
+from django.db.models import Exists, F, Max, OuterRef, Prefetch, Q, prefetch_related_objects
+from django.template.loader import get_template
+from django.utils.safestring import mark_safe
 from dal import autocomplete
-from .models import Chemical, Stock, Extraction, Storage, Distributor, Workgroup, ChemicalList, ChemicalSynonym, Unit, Post
+from users.models import Profile
+from .models import Chemical, Stock, Extraction, Storage, Distributor, Workgroup, ChemicalList, ChemicalSynonym, Unit, Post, \
+    Job, ChemicalConsumption
 from .forms import ChemicalCreateForm, StockUpdateForm, ExtractionCreateForm, StorageCreateForm, SearchParameterForm, \
-    ChemicalListUploadForm, ChemicalListVerifyForm
+    ChemicalListUploadForm, ChemicalListVerifyForm, ExtractionBatchForm, ExtractionBatchFormSet
 from .utils import PubChemLoader, unit_converter, update_chemical_synonyms
+from .search import matching_entries, ranked_chemicals
+from .pubchem import alookup_name
+from .pagination import InvalidCursor, keyset_page
+from .permissions import AccessSnapshotMixin, get_access
+from .extractions import BatchError, record_extractions
+from .importer import read_inventory
+from . import directory, export, fragments, jobs, metrics, typeahead
 from braces import views
-from django.shortcuts import redirect
-import pandas as pd
+from django.shortcuts import get_object_or_404, redirect
 from django.shortcuts import render
 
+logger = logging.getLogger(__name__)
+
+
 def about(request):
     return render(request, 'chemmanager/about.html', {'title': 'About'})
 
@@ -35,9 +58,8 @@ class ChemicalDetailView(LoginRequiredMixin, DetailView):
 class SearchParameterAutocomplete(LoginRequiredMixin, autocomplete.Select2ListView):
     def get_list(self):
         parameter_list = ['only stocked']
-        for my_storage in Storage.objects.filter(shared_workgroups=self.request.user.profile.workgroup).all():
-            parameter_list.append(my_storage.workgroup.name)
-        return list(set(parameter_list))
+        parameter_list += sorted(directory.sharing_workgroups(self.request.user.profile.workgroup_id).values())
+        return parameter_list
 
 
 class DistributorAutocomplete(LoginRequiredMixin, autocomplete.Select2QuerySetView):
@@ -50,10 +72,14 @@ class DistributorAutocomplete(LoginRequiredMixin, autocomplete.Select2QuerySetVi
         return qs
 
 
-class StockCreateView(LoginRequiredMixin, UserPassesTestMixin, CreateView):
+class StockCreateView(AccessSnapshotMixin, LoginRequiredMixin, UserPassesTestMixin, CreateView):
     model = Stock
     form_class = StockUpdateForm
 
+    @cached_property
+    def chemical(self):
+        return Chemical.objects.filter(pk=self.request.GET.get('chemical')).first()
+
     def get_form_kwargs(self):
         """Pass Request for filtering storage drop-down"""
         kwargs = super(StockCreateView, self).get_form_kwargs()
@@ -63,25 +89,19 @@ class StockCreateView(LoginRequiredMixin, UserPassesTestMixin, CreateView):
         return kwargs
 
     def form_valid(self, form):
-        chemical_id = self.request.GET.get('chemical')
-        form.instance.chemical = Chemical.objects.get(pk=chemical_id)
+        form.instance.chemical = self.chemical
         return super().form_valid(form)
 
     def get_context_data(self, **kwargs):
         context = super(StockCreateView, self).get_context_data(**kwargs)
-        chemical_id = self.request.GET.get('chemical')
-        context['chemical'] = Chemical.objects.get(pk=chemical_id).name
+        context['chemical'] = self.chemical.name
 
         return context
 
     def test_func(self):
         """Only Workgroup-Members are allowed to edit, Shared Groups are only permitted to create extractions!
         Otherwise Members of different Groups could change storage, which is not allowed"""
-        if Chemical.objects.filter(id=self.request.GET.get('chemical'),
-                                   workgroup=self.request.user.profile.workgroup).count() > 0:
-            return True
-        else:
-            return False
+        return self.access.can_add_stock(self.chemical)
 
     def handle_no_permission(self):
         messages.add_message(self.request, messages.WARNING, 'You are not permitted to apply changes! '
@@ -89,21 +109,13 @@ class StockCreateView(LoginRequiredMixin, UserPassesTestMixin, CreateView):
         return HttpResponseRedirect(reverse_lazy('chemmanager-home'))
 
 
-class ChemicalListView(views.JSONResponseMixin, views.AjaxResponseMixin, LoginRequiredMixin, ListView):
-    # TODO user passes test!
-    # TODO Search-parameter should not be reset on page reload!
-    model = Chemical
-
-    template_name = 'chemmanager/chemdata_home.html'
-    context_object_name = 'chemicals'
-    paginate_by = 50
-    extra_context = {
-        'title': 'Chemical Manager',
-        'chemical_detail': None,
-    }
+class ChemicalQueryMixin:
+    """Chemicals of the users workgroup plus those of the workgroups selected with ?p= that are stocked in storages
+    shared with it, filtered by the search query ?q="""
 
     def get_queryset(self):
-        object_list = Chemical.objects.filter(workgroup=self.request.user.profile.workgroup)
+        workgroup = self.request.user.profile.workgroup
+        visible = Q(workgroup=workgroup)
 
         parameter = self.request.GET.getlist('p')
         # TODO add extra parameters
@@ -115,42 +127,179 @@ class ChemicalListView(views.JSONResponseMixin, views.AjaxResponseMixin, LoginRe
             parameter.remove('only stocked')
             extra_parameter['only_stocked'] = True
 
-        for param in parameter:
-            curr_workgroup = Workgroup.objects.get(name=param)
-            # Iterate through all search parameter, check if Storage is shared with current users workgroup!
-            object_list = object_list | Chemical.objects.filter(
-                stock__storage__shared_workgroups=self.request.user.profile.workgroup,
-                workgroup=curr_workgroup).exclude(secret=True)
+        sharing = directory.resolve(workgroup.pk if workgroup else None, parameter) if parameter else []
+        if sharing:
+            # Chemicals of the selected workgroups in a storage shared with the current users workgroup. Subqueries
+            # instead of joins, so no row is duplicated and the list needs no DISTINCT.
+            shared_stocks = Stock.objects_with_deleted.filter(storage__shared_workgroups=workgroup)
+            visible |= Q(workgroup_id__in=sharing, pk__in=shared_stocks.values('chemical')) & ~Q(secret=True)
+        object_list = Chemical.objects.filter(visible)
 
         if extra_parameter.get('only_stocked'):
-            object_list = object_list.annotate(count_st=Count('stock')).filter(count_st__gt=0)
+            object_list = object_list.filter(Exists(Stock.objects_with_deleted.filter(chemical=OuterRef('pk'))))
 
         query = self.request.GET.get('q')
         if query:
-            object_list = object_list.filter(name__icontains=query) | object_list.filter(
-                cas__startswith=query) | object_list.filter(chemicalsynonym__name__icontains=query)
+            object_list = object_list.filter(pk__in=matching_entries(query).values('chemical'))
 
         # Sort by most available / largest stock count and than by name!
         # object_list = object_list.annotate(count=Count('stock__id')).order_by('-count', 'name').distinct()
-        object_list = object_list.order_by('name').distinct()
-        return object_list
+        return object_list.order_by('name', 'pk')
+
+
+class ChemicalListView(ChemicalQueryMixin, LoginRequiredMixin, ListView):
+    # TODO user passes test!
+    # TODO Search-parameter should not be reset on page reload!
+    model = Chemical
+
+    template_name = 'chemmanager/chemdata_home.html'
+    context_object_name = 'chemicals'
+    paginate_by = 50
+    extra_context = {
+        'title': 'Chemical Manager',
+        'chemical_detail': None,
+    }
+
+    def paginate_queryset(self, queryset, page_size):
+        return super().paginate_queryset(queryset.select_related('workgroup'), page_size)
+
+    def render_cards(self, chemicals):
+        """Cards of chemicals not in the fragment cache, everything they show loaded with a fixed number of queries"""
+        stocks = Stock.objects.select_related('distributor', 'unit', 'storage') \
+            .prefetch_related('storage__shared_workgroups') \
+            .annotate(last_extraction=Max('extraction__date_created'))
+        prefetch_related_objects(chemicals, Prefetch('stock_set', queryset=stocks))
+        template = get_template('chemmanager/chemical_card.html')
+        return [template.render({'chemical': chemical, 'request': self.request}) for chemical in chemicals]
 
     def get_context_data(self, **kwargs):
         parameter_form = SearchParameterForm()
         kwargs.update({
             'parameter_form': parameter_form,
         })
-        return super(ChemicalListView, self).get_context_data(**kwargs)
+        context = super(ChemicalListView, self).get_context_data(**kwargs)
+        # Cards differ by the workgroup of the viewer and the columns shown for the device
+        viewer = str(self.request.user.profile.workgroup_id)
+        agent = getattr(self.request, 'user_agent', None)
+        if agent is not None:
+            viewer += f':{agent.is_pc:d}{agent.is_mobile:d}'
+        cards = fragments.get_cards(list(context['chemicals']), viewer, self.render_cards)
+        context['cards'] = [mark_safe(card) for card in cards]
+        return context
 
-    def get_ajax(self, request, *args, **kwargs):
+    # paginate_by = 6
+
+
+class ChemicalApiView(ChemicalQueryMixin, views.JSONResponseMixin, LoginRequiredMixin, View):
+    """
+    Chemical listing for scripts and instruments: same filters as the chemical list (?q=, ?p=), paged by an opaque
+    ?cursor= taken from "next" of the previous page. ?limit= sets the page size, ?count=1 adds the total.
+    """
+    default_limit = 100
+    max_limit = 1000
+
+    def get(self, request, *args, **kwargs):
+        try:
+            limit = min(int(request.GET.get('limit', self.default_limit)), self.max_limit)
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            return self.render_json_response({'error': 'limit must be a positive number'}, status=400)
         queryset = self.get_queryset()
-        name_list = []
-        for query_object in queryset.all():
-            name_list.append(query_object.name)
-        response = {'names': name_list}
+        try:
+            chemicals, cursor = keyset_page(queryset.select_related('workgroup'), request.GET.get('cursor'), limit)
+        except InvalidCursor as error:
+            return self.render_json_response({'error': str(error)}, status=400)
+
+        response = {
+            'results': [{
+                'id': chemical.pk,
+                'name': chemical.name,
+                'cas': chemical.cas,
+                'cid': chemical.cid,
+                'structure': chemical.structure,
+                'molar_mass': chemical.molar_mass,
+                'workgroup': chemical.workgroup.name if chemical.workgroup else None,
+                'url': request.build_absolute_uri(reverse('chemical-detail', args=[chemical.pk])),
+            } for chemical in chemicals],
+            'next': None,
+        }
+        if cursor is not None:
+            parameters = request.GET.copy()
+            parameters['cursor'] = cursor
+            response['next'] = request.build_absolute_uri('?' + parameters.urlencode())
+        # Counting scans every match, only done on request
+        if request.GET.get('count') in ('1', 'true'):
+            response['count'] = queryset.count()
         return self.render_json_response(response)
 
-    # paginate_by = 6
+
+async def _workgroup_id(request):
+    """Workgroup of the logged in user, request.user.profile can not be loaded in async code"""
+    user = await request.auser()
+    return await Profile.objects.filter(user=user).values_list('workgroup_id', flat=True).afirst()
+
+
+def _limit(request, default, maximum):
+    try:
+        return max(1, min(int(request.GET.get('limit', default)), maximum))
+    except ValueError:
+        return default
+
+
+# The async views below are wrapped with login_required in urls.py, LoginRequiredMixin does not support async views.
+
+class ChemicalTypeaheadView(views.JSONResponseMixin, View):
+    """Suggestions for the chemical search: at most ?limit= names of the users workgroup starting with ?q="""
+    default_limit = 10
+    max_limit = 50
+
+    async def get(self, request, *args, **kwargs):
+        limit = _limit(request, self.default_limit, self.max_limit)
+        workgroup_id = await _workgroup_id(request)
+        # Answered from the process wide index, only building it queries the database
+        names = await sync_to_async(typeahead.complete)(workgroup_id, request.GET.get('q', ''), limit)
+        return self.render_json_response({'names': names})
+
+
+class ChemicalSearchView(views.JSONResponseMixin, View):
+    """At most ?limit= chemicals of the users workgroup matching ?q=, best match first"""
+    default_limit = 20
+    max_limit = 100
+
+    async def get(self, request, *args, **kwargs):
+        query = request.GET.get('q', '')
+        if not query.strip():
+            return self.render_json_response({'results': []})
+        limit = _limit(request, self.default_limit, self.max_limit)
+        chemicals = Chemical.objects.filter(workgroup_id=await _workgroup_id(request))
+        pks = [row['chemical'] async for row in ranked_chemicals(query, chemicals)[:limit]]
+        names = {pk: name async for pk, name in Chemical.objects.filter(pk__in=pks).values_list('pk', 'name')}
+        return self.render_json_response({'results': [
+            {'id': pk, 'name': names[pk], 'url': reverse('chemical-detail', args=[pk])} for pk in pks]})
+
+
+class PubChemLookupView(views.JSONResponseMixin, View):
+    """
+    Structure, molar mass and CID of ?name= from the PubChem cache or PubChem, used by "Check PubChem!" on the
+    chemical form. The worker is free while PubChem answers, which takes at most PUBCHEM_TIMEOUT seconds.
+    """
+
+    async def get(self, request, *args, **kwargs):
+        name = request.GET.get('name', '').strip()
+        if not name:
+            return self.render_json_response({'error': 'name is required'}, status=400)
+        try:
+            compound = await alookup_name(name)
+        except httpx.TimeoutException:
+            return self.render_json_response({'error': 'PubChem did not answer in time'}, status=504)
+        except (httpx.HTTPError, pcp.PubChemPyError, OSError) as error:
+            logger.warning('PubChem lookup for %s failed: %s', name, error)
+            return self.render_json_response({'error': 'PubChem is not available'}, status=502)
+        if compound is None:
+            return self.render_json_response({'found': False})
+        return self.render_json_response({'found': True, 'cid': compound.cid, 'structure': compound.molecular_formula,
+                                          'molar_mass': compound.molecular_weight})
 
 
 class ChemicalTableView(ChemicalListView):
@@ -158,7 +307,50 @@ class ChemicalTableView(ChemicalListView):
 
     template_name = 'chemmanager/chemicaltable_list.html'
     context_object_name = 'chemicals'
-    paginate_by = 100000
+    # The whole inventory is available from ChemicalExportView
+    paginate_by = 200
+
+    def paginate_queryset(self, queryset, page_size):
+        """Stocks of the page as a list, the template shows their count and the last one"""
+        # Stock.Meta ordering (-date_changed) like chemical.stock_set.all did, so the last is the least recently changed
+        stocks = Stock.objects.select_related('storage')
+        queryset = queryset.prefetch_related(Prefetch('stock_set', queryset=stocks, to_attr='stocks'))
+        return super().paginate_queryset(queryset, page_size)
+
+    def get_context_data(self, **kwargs):
+        # Rows instead of cards, none of the card rendering of ChemicalListView
+        return super(ChemicalListView, self).get_context_data(**kwargs)
+
+
+class ChemicalExportView(LoginRequiredMixin, View):
+    """Whole inventory of the users workgroup as csv, json or xlsx, streamed while it is read"""
+
+    def get(self, request, *args, **kwargs):
+        file_format = kwargs.get('format')
+        if file_format not in export.FORMATS:
+            raise Http404(f'Unknown export format "{file_format}"')
+        rows = export.inventory_rows(request.user.profile.workgroup)
+        response = StreamingHttpResponse(export.STREAMS[file_format](rows), content_type=export.FORMATS[file_format])
+        response['Content-Disposition'] = f'attachment; filename="inventory.{file_format}"'
+        return response
+
+
+class ConsumptionView(LoginRequiredMixin, ListView):
+    """
+    Chemicals of the users workgroup in the order they run out, read from the summary table of chemmanager.analytics.
+    ?days= only lists those forecast to run out within that many days.
+    """
+    template_name = 'chemmanager/consumption_list.html'
+    context_object_name = 'forecasts'
+    paginate_by = 100
+
+    def get_queryset(self):
+        forecasts = ChemicalConsumption.objects.filter(chemical__workgroup=self.request.user.profile.workgroup)
+        days = self.request.GET.get('days', '')
+        if days.isdigit():
+            forecasts = forecasts.filter(depletion_date__lte=timezone.localdate() + timedelta(days=int(days)))
+        return forecasts.select_related('chemical', 'unit').order_by(F('depletion_date').asc(nulls_last=True),
+                                                                     '-rate', 'pk')
 
 
 class ChemicalCreateView(CreateView):
@@ -207,6 +399,8 @@ class ChemicalCreateView(CreateView):
             # TODO Write Stock creation after chemical creation here
             update_chemical_synonyms(chemical=chemical,
                                      synonyms=form.cleaned_data.get('synonyms').splitlines())
+            if not chemical.cid:
+                jobs.enqueue('enrich_chemical', user=self.request.user, chemical=chemical.id)
 
             return HttpResponseRedirect(
                 reverse_lazy('chemical-list', kwargs={'pk': chemical.id}) + f'?q={chemical.name}')
@@ -219,7 +413,7 @@ class ChemicalCreateView(CreateView):
         return form
 
 
-class ChemicalUpdateView(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
+class ChemicalUpdateView(AccessSnapshotMixin, LoginRequiredMixin, UserPassesTestMixin, UpdateView):
     model = Chemical
     form_class = ChemicalCreateForm
     extra_context = {
@@ -247,7 +441,8 @@ class ChemicalUpdateView(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
                                      f'Could not find Substance on PubChem!')
                 return self.render_to_response(context)
         else:
-            if (form.cleaned_data.get('name') != chemical.name) and \
+            # The form has written the new values into chemical already, the old name is its initial
+            if (form.cleaned_data.get('name') != form.initial.get('name')) and \
                     (Chemical.objects.filter(name=form.cleaned_data.get('name'),
                                              workgroup=self.request.user.profile.workgroup).count() > 0):
                 messages.add_message(self.request, messages.WARNING,
@@ -271,11 +466,7 @@ class ChemicalUpdateView(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
         return form
 
     def test_func(self):
-        chemical = self.get_object()
-        if self.request.user == chemical.creator:
-            return True
-        else:
-            return False
+        return self.access.is_creator(self.get_object())
 
     def handle_no_permission(self):
         messages.add_message(self.request, messages.WARNING, 'You are not permitted to apply changes! '
@@ -283,7 +474,7 @@ class ChemicalUpdateView(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
         return HttpResponseRedirect(reverse_lazy('chemmanager-home'))
 
 
-class ChemicalDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
+class ChemicalDeleteView(AccessSnapshotMixin, LoginRequiredMixin, UserPassesTestMixin, DeleteView):
     model = Chemical
     success_url = reverse_lazy('chemmanager-home')
 
@@ -297,11 +488,7 @@ class ChemicalDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
             return super().delete(request, *args, **kwargs)
 
     def test_func(self):
-        chemical = self.get_object()
-        if self.request.user == chemical.creator:
-            return True
-        else:
-            return False
+        return self.access.is_creator(self.get_object())
 
     def handle_no_permission(self):
         messages.add_message(self.request, messages.WARNING, 'You are not permitted to apply changes! '
@@ -309,9 +496,10 @@ class ChemicalDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
         return HttpResponseRedirect(reverse_lazy('chemmanager-home'))
 
 
-class StockDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
+class StockDeleteView(AccessSnapshotMixin, LoginRequiredMixin, UserPassesTestMixin, DeleteView):
     model = Stock
     success_url = reverse_lazy('chemmanager-home')
+    related_objects = ('chemical',)
 
     def delete(self, request, *args, **kwargs):
         stock = self.get_object()
@@ -320,11 +508,7 @@ class StockDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
 
     def test_func(self):
         """Check if User is in group and allowed to remove Stock"""
-        stock = self.get_object()
-        if self.request.user.profile.workgroup == stock.storage.workgroup:
-            return True
-        else:
-            return False
+        return self.access.can_remove_stock(self.get_object())
 
     def handle_no_permission(self):
         messages.add_message(self.request, messages.WARNING, 'You are not permitted to apply changes! '
@@ -332,9 +516,10 @@ class StockDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
         return HttpResponseRedirect(reverse_lazy('chemmanager-home'))
 
 
-class StockUpdateView(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
+class StockUpdateView(AccessSnapshotMixin, LoginRequiredMixin, UserPassesTestMixin, UpdateView):
     model = Stock
     form_class = StockUpdateForm
+    related_objects = ('chemical',)
 
     def get_form_kwargs(self):
         kwargs = super(StockUpdateView, self).get_form_kwargs()
@@ -346,11 +531,7 @@ class StockUpdateView(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
     def test_func(self):
         """Only Workgroup-Members are allowed to edit, Shared Groups are only permited to create extractions!
         Otherwise Members of different Groups could change storage, which is not allowed"""
-        stock = self.get_object()
-        if self.request.user.profile.workgroup == stock.chemical.workgroup:
-            return True
-        else:
-            return False
+        return self.access.can_edit_stock(self.get_object())
 
     def handle_no_permission(self):
         messages.add_message(self.request, messages.WARNING, 'You are not permitted to apply changes! '
@@ -358,26 +539,32 @@ class StockUpdateView(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
         return HttpResponseRedirect(reverse_lazy('chemmanager-home'))
 
 
-class ExtractionCreateView(LoginRequiredMixin, UserPassesTestMixin, CreateView):
+def empty_stock_message(request, stock):
+    path = reverse('stock-delete', args=[stock.id])
+    messages.add_message(request, messages.WARNING,
+                         f'<div class="d-flex justify-content-between align-items-center"> <div>Stock for <b>{stock.chemical.name}</b> seems to be empty.</div> <a class="btn btn-outline-danger" href="{path}">Remove Stock!</a> </div>',
+                         extra_tags='safe')
+
+
+class ExtractionCreateView(AccessSnapshotMixin, LoginRequiredMixin, UserPassesTestMixin, CreateView):
     model = Extraction
     form_class = ExtractionCreateForm
 
+    @cached_property
+    def stock(self):
+        return get_object_or_404(Stock.objects.select_related('chemical', 'unit'), pk=self.kwargs['pk'])
+
     def get_form(self, form_class=None):
         """Get unit from the associated stock"""
         form = super().get_form(form_class)
-        form['unit'].initial = Stock.objects.get(id=self.kwargs['pk']).unit
+        form['unit'].initial = self.stock.unit
         return form
 
     def get_context_data(self, **kwargs):
-        stock = Stock.objects.get(id=self.kwargs['pk'])
-        extractions = stock.extraction_set.all()
-        # TODO Use units!
-        left_quantity = stock.quantity
-        for extraction in extractions:
-            left_quantity -= unit_converter(extraction.quantity, extraction.unit, stock)
+        stock = self.stock
         kwargs.update({
             'stock': stock,
-            'left_quantity': left_quantity,
+            'left_quantity': stock.left_quantity,
         })
         return super(ExtractionCreateView, self).get_context_data(**kwargs)
 
@@ -386,15 +573,12 @@ class ExtractionCreateView(LoginRequiredMixin, UserPassesTestMixin, CreateView):
             form.instance.user = None
         else:
             form.instance.user = self.request.user
-        stock = Stock.objects.get(id=self.kwargs['pk'])
+        stock = self.stock
         form.instance.stock = stock
-        if unit_converter(form.cleaned_data.get('quantity'), form.cleaned_data.get('unit'), stock):
-            if (stock.left_quantity - unit_converter(form.cleaned_data.get('quantity'), form.cleaned_data.get('unit'),
-                                                     stock)) <= 0:
-                path = reverse('stock-delete', args=[stock.id])
-                messages.add_message(self.request, messages.WARNING,
-                                     f'<div class="d-flex justify-content-between align-items-center"> <div>Stock for <b>{stock.chemical.name}</b> seems to be empty.</div> <a class="btn btn-outline-danger" href="{path}">Remove Stock!</a> </div>',
-                                     extra_tags='safe')
+        converted_quantity = unit_converter(form.cleaned_data.get('quantity'), form.cleaned_data.get('unit'), stock)
+        if converted_quantity:
+            if (stock.left_quantity - converted_quantity) <= 0:
+                empty_stock_message(self.request, stock)
 
             return super().form_valid(form)
         else:
@@ -405,18 +589,10 @@ class ExtractionCreateView(LoginRequiredMixin, UserPassesTestMixin, CreateView):
 
     def test_func(self):
         """Check if User is in group and allowed to add Extraction
-        Allow if stock_storage_workgroup is in workgroup of the user or if stock has no workgroup.
+        Allow if the chemical belongs to the workgroup of the user or the storage is shared with it.
         Permit if Chemical is set to secret!
         """
-        my_stock = Stock.objects.get(pk=self.kwargs['pk'])
-        if my_stock.storage.shared_workgroups.filter(storage__shared_workgroups=self.request.user.profile.workgroup) or \
-                my_stock.chemical.workgroup == self.request.user.profile.workgroup:
-            if my_stock.chemical.secret and my_stock.chemical.workgroup != self.request.user.profile.workgroup:
-                return False
-            return True
-
-        else:
-            return False
+        return self.access.can_extract(self.stock)
 
     def handle_no_permission(self):
         messages.add_message(self.request, messages.WARNING, 'You are not permitted to apply changes! '
@@ -424,6 +600,83 @@ class ExtractionCreateView(LoginRequiredMixin, UserPassesTestMixin, CreateView):
         return HttpResponseRedirect(reverse_lazy('chemmanager-home'))
 
 
+class ExtractionBatchView(views.JSONResponseMixin, LoginRequiredMixin, View):
+    """
+    Many extractions at once, e.g. after a synthesis session. The form lists the stocks given as ?stock= plus empty
+    rows taking a stock id. Scripts post JSON {"extractions": [{"stock": 1, "quantity": 2.5, "unit": "g"}, ...],
+    "comment": ..., "anonymous": false} and get back the stocks that are used up. A batch with an invalid row (unknown
+    stock, no permission, unit not convertible) is rejected as a whole.
+    """
+    template_name = 'chemmanager/extraction_batch.html'
+
+    def units(self):
+        return list(Unit.objects.order_by('name').values_list('pk', 'name'))
+
+    def render_form(self, form, formset, stocks=None):
+        stocks = stocks or {}
+        rows = [(row, stocks.get(row.initial.get('stock'))) for row in formset]
+        return render(self.request, self.template_name, {'form': form, 'formset': formset, 'rows': rows,
+                                                         'title': 'Extractions'})
+
+    def listed_stocks(self):
+        """The stocks given as ?stock= (the form posts to the same url) and the initial rows for them"""
+        pks = [int(pk) for pk in self.request.GET.getlist('stock') if pk.isdigit()]
+        stocks = Stock.objects.select_related('chemical', 'storage', 'unit').in_bulk(pks)
+        return stocks, [{'stock': pk, 'unit': stocks[pk].unit_id} for pk in pks if pk in stocks]
+
+    def get(self, request, *args, **kwargs):
+        stocks, initial = self.listed_stocks()
+        formset = ExtractionBatchFormSet(initial=initial, form_kwargs={'units': self.units()})
+        return self.render_form(ExtractionBatchForm(), formset, stocks)
+
+    def post(self, request, *args, **kwargs):
+        if request.content_type == 'application/json':
+            return self.post_json(request)
+        stocks, initial = self.listed_stocks()
+        form = ExtractionBatchForm(request.POST)
+        formset = ExtractionBatchFormSet(request.POST, initial=initial, form_kwargs={'units': self.units()})
+        if not (form.is_valid() and formset.is_valid()):
+            return self.render_form(form, formset, stocks)
+        filled = [row for row in formset if row.cleaned_data.get('quantity') is not None]
+        try:
+            empty = record_extractions([row.cleaned_data for row in filled], get_access(request),
+                                       user=None if form.cleaned_data['anonymous'] else request.user,
+                                       comment=form.cleaned_data['comment'] or None,
+                                       date_created=form.cleaned_data['date_created'])
+        except BatchError as error:
+            for i, message in error.errors.items():
+                filled[i].add_error(None, message)
+            return self.render_form(form, formset, stocks)
+        messages.add_message(request, messages.SUCCESS, f'{len(filled)} extractions recorded.')
+        for stock in empty:
+            empty_stock_message(request, stock)
+        return HttpResponseRedirect(reverse('chemmanager-home'))
+
+    def post_json(self, request):
+        try:
+            data = json.loads(request.body)
+            rows = [{'stock': int(row['stock']), 'quantity': float(row['quantity']), 'unit': row['unit']}
+                    for row in data['extractions']]
+            # A unit is a name or an id, anything else would reach the unit converter
+            if any(isinstance(row['unit'], bool) or not isinstance(row['unit'], (str, int)) for row in rows):
+                raise TypeError('unit')
+        except (ValueError, KeyError, TypeError):
+            return self.render_json_response({'error': 'Expected {"extractions": [{"stock": id, "quantity": number, '
+                                                       '"unit": name or id}, ...]}'}, status=400)
+        try:
+            empty = record_extractions(rows, get_access(request),
+                                       user=None if data.get('anonymous') else request.user,
+                                       comment=data.get('comment'))
+        except BatchError as error:
+            return self.render_json_response({'errors': error.errors}, status=400)
+        return self.render_json_response({
+            'created': len(rows),
+            'empty': [{'id': stock.pk, 'chemical': stock.chemical.name, 'label': stock.label,
+                       'remaining_quantity': stock.remaining_quantity,
+                       'remove_url': reverse('stock-delete', args=[stock.pk])} for stock in empty],
+        }, status=201)
+
+
 class StorageListView(LoginRequiredMixin, ListView):
     # TODO child storage has to have the same workgroup as parent!
     model = Storage
@@ -435,12 +688,24 @@ class StorageListView(LoginRequiredMixin, ListView):
         return object_list.order_by('name').distinct()
 
 
-class StorageCreateView(LoginRequiredMixin, CreateView):
-    # TODO UserPassesTest!
+class StorageCreateView(AccessSnapshotMixin, LoginRequiredMixin, UserPassesTestMixin, CreateView):
     model = Storage
     form_class = StorageCreateForm
     success_url = reverse_lazy('storage-list')
 
+    @cached_property
+    def root_storage(self):
+        return Storage.objects.get(id=self.kwargs['pk'])
+
+    def test_func(self):
+        """Child storages only below storages of the own workgroup"""
+        return self.kwargs['pk'] == 0 or self.kwargs['pk'] in self.access.owned_storages
+
+    def handle_no_permission(self):
+        messages.add_message(self.request, messages.WARNING, 'You are not permitted to apply changes! '
+                                                             'Please contact your group admin.')
+        return HttpResponseRedirect(reverse_lazy('storage-list'))
+
     def form_valid(self, form):
         # print(form.cleaned_data)
         if self.kwargs['pk'] == 0:  # If not child create root
@@ -449,7 +714,7 @@ class StorageCreateView(LoginRequiredMixin, CreateView):
                                            workgroup=self.request.user.profile.workgroup)
             workgroups = form.cleaned_data.get('shared_workgroups')
         else:  # Create Child!
-            root_storage = Storage.objects.get(id=self.kwargs['pk'])
+            root_storage = self.root_storage
             set_storage = root_storage.add_child(name=form.instance.name, room=form.instance.room,
                                                  creator=self.request.user, abbreviation=form.instance.abbreviation,
                                                  workgroup=self.request.user.profile.workgroup)
@@ -466,7 +731,7 @@ class StorageCreateView(LoginRequiredMixin, CreateView):
         # Removing owner workgroup from list
         form.fields['shared_workgroups'].queryset = Workgroup.objects.exclude(pk=self.request.user.profile.workgroup_id)
         if self.kwargs['pk'] != 0:  # Look for root storage (editing child storage here!)
-            root_storage = Storage.objects.get(id=self.kwargs['pk'])
+            root_storage = self.root_storage
             form.fields['shared_workgroups'].initial = root_storage.shared_workgroups.all()
             form.fields['room'].initial = root_storage.room
 
@@ -474,9 +739,8 @@ class StorageCreateView(LoginRequiredMixin, CreateView):
 
     def get_context_data(self, **kwargs):
         if self.kwargs['pk'] != 0:
-            root_storage = Storage.objects.get(id=self.kwargs['pk'])
             kwargs.update({
-                'root_storage': root_storage,
+                'root_storage': self.root_storage,
             })
         return super(StorageCreateView, self).get_context_data(**kwargs)
 
@@ -487,17 +751,13 @@ class StorageUpdateView(UpdateView):
     success_url = reverse_lazy('storage-list')
 
 
-class StorageDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
+class StorageDeleteView(AccessSnapshotMixin, LoginRequiredMixin, UserPassesTestMixin, DeleteView):
     model = Storage
     success_url = reverse_lazy('storage-list')
 
     def test_func(self):
         """Check if User is in group and allowed to remove Stock"""
-        storage = self.get_object()
-        if storage.creator == self.request.user:
-            return True
-        else:
-            return False
+        return self.access.is_creator(self.get_object())
 
     def handle_no_permission(self):
         messages.add_message(self.request, messages.WARNING, 'You are not permitted to apply changes! '
@@ -526,19 +786,31 @@ class ChemicalListUploadView(LoginRequiredMixin, UserPassesTestMixin, CreateView
             return self.render_to_response(context)
 
 
-class ChemicalListVerifyView(LoginRequiredMixin, UserPassesTestMixin, ListView):
+class ChemicalListVerifyView(AccessSnapshotMixin, LoginRequiredMixin, UserPassesTestMixin, ListView):
     template_name = 'chemmanager/chemicallist_list.html'
     model = ChemicalList
+    preview_rows = 100
+
+    @cached_property
+    def chemicallist(self):
+        return get_object_or_404(ChemicalList, id=self.kwargs['pk'])
 
     def test_func(self):
-        return True
+        """Lists are imported into the workgroup they were uploaded for"""
+        return self.chemicallist.workgroup_id == self.access.workgroup_id
+
+    def handle_no_permission(self):
+        messages.add_message(self.request, messages.WARNING, 'You are not permitted to apply changes! '
+                                                             'Please contact your group admin.')
+        return HttpResponseRedirect(reverse_lazy('chemmanager-home'))
 
     def get_context_data(self, **kwargs):
         '''gets data from uploaded csv-file and prints out its data'''
         context = super().get_context_data(**kwargs)
-        my_chemicallist = ChemicalList.objects.get(id=self.kwargs['pk'])
+        my_chemicallist = self.chemicallist
 
-        frame = pd.read_csv(my_chemicallist.file.path, engine='python', sep=None)
+        # Only a preview, the import itself streams the whole file
+        frame = read_inventory(my_chemicallist.file.path, nrows=self.preview_rows)
         context['frame'] = frame.to_dict('split')
         context['form'] = ChemicalListVerifyForm(columns=frame.columns)
         return context
@@ -564,56 +836,39 @@ class ChemicalListVerifyView(LoginRequiredMixin, UserPassesTestMixin, ListView):
             # TODO keep forms filled
             return self.get(request, args, kwargs)
 
-        my_chemicallist = ChemicalList.objects.get(id=self.kwargs['pk'])
-        frame = pd.read_csv(my_chemicallist.file.path, engine='python', sep=None)
-        # col_dict = {v: int(k) for k, v in request.POST.items()} #inverts e.g. 1: chemical -> chemical: 1
-
-        for index, row in frame.iterrows():
-            # print('---------------------')
-            # print(row)
-            # print(col_dict)
-            # print('---------------------')
-            chemical, created = Chemical.objects.get_or_create(name=row[col_dict.get('chemical')],
-                                                               defaults={'creator': self.request.user,
-                                                                         'workgroup': self.request.user.profile.workgroup})
-            # if not created:
-            # try:
-            #     stock = Stock.objects.get(chemical=chemical, label=row[col_dict.get('label')])
-            #     # TODO WHY?
-            # except (Stock.DoesNotExist, KeyError):
-            stock = Stock(chemical=chemical)
-            if 'quantity' in col_dict:
-                # try:
-                #     stock.quantity = float(row[col_dict.get('quantity')].replace("[^0-9]", ""))
-                # except ValueError:
-                stock.quantity = -1
-                # stock.quantity = 1  # TODO convert quantity to float
-
-            if 'unit' in col_dict:
-                try:
-                    stock.unit = Unit.objects.get(name=row[col_dict.get('unit')])
-                except Unit.DoesNotExist:
-                    stock.unit = Unit.objects.get(name='None')
-            else:
-                stock.unit = Unit.objects.get(name='None')
+        my_chemicallist = self.chemicallist
+        job = jobs.enqueue('import_inventory', user=self.request.user, chemicallist=my_chemicallist.id,
+                           columns=col_dict)
+        messages.add_message(self.request, messages.INFO, 'Import started, you can leave this page.')
+        return HttpResponseRedirect(job.get_absolute_url())
 
-            if 'label' in col_dict:
-                stock.label = row[col_dict.get('label')]
 
-            if 'storage' in col_dict:
-                try:
-                    stock.storage = Storage.objects.get(name=row[col_dict.get('storage')])
-                except Storage.DoesNotExist:
-                    stock.storage = Storage.add_root(name=row[col_dict.get('storage')], creator=self.request.user,
-                                                     workgroup=self.request.user.profile.workgroup)
-            else:
-                # When no storage is selected, then everything will be stored in a (new) "default" storage
-                try:
-                    stock.storage = Storage.objects.get(name='default')
-                except Storage.DoesNotExist:
-                    stock.storage = Storage.add_root(name='default', creator=self.request.user,
-                                                     workgroup=self.request.user.profile.workgroup)
+class JobDetailView(AccessSnapshotMixin, views.JSONResponseMixin, views.AjaxResponseMixin, LoginRequiredMixin,
+                    UserPassesTestMixin, DetailView):
+    """Progress of a background job, polled via ajax by the page itself"""
+    model = Job
+
+    def get_ajax(self, request, *args, **kwargs):
+        job = self.get_object()
+        return self.render_json_response({
+            'status': job.status,
+            'progress': job.progress,
+            'total': job.total,
+            'message': job.message,
+        })
+
+    def test_func(self):
+        return self.get_object().user == self.request.user
+
+    def handle_no_permission(self):
+        messages.add_message(self.request, messages.WARNING, 'You are not permitted to view this job!')
+        return HttpResponseRedirect(reverse_lazy('chemmanager-home'))
+
 
-            stock.save()
+class MetricsView(View):
+    """Request metrics of this process in the Prometheus text format"""
 
-        return self.get(request, *args, **kwargs)
+    def get(self, request, *args, **kwargs):
+        if not (request.user.is_staff or request.META.get('REMOTE_ADDR') in getattr(settings, 'INTERNAL_IPS', [])):
+            raise PermissionDenied
+        return HttpResponse(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,6 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import User
-from PIL import Image
+from chemmanager.images import content_address, thumbnail_url
 
 
 class Workgroup(models.Model):
@@ -14,16 +14,16 @@ class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     image = models.ImageField(default='profile_pics/default.png', upload_to='profile_pics')
     workgroup = models.ForeignKey(Workgroup, on_delete=models.CASCADE, blank=True, null=True)
+    THUMBNAIL_SIZE = 300
 
     def __str__(self):
         return f'{self.user.username} Profile'
 
+    @property
+    def thumbnail_url(self):
+        return thumbnail_url(self.image, self.THUMBNAIL_SIZE)
+
     def save(self, *args, **kwargs):
+        # The image is only opened by the thumbnail job, not on every save (see signals)
+        self._image_changed = content_address(self.image)
         super().save(*args, **kwargs)
-
-        with Image.open(self.image.path) as img:
-
-            if img.height > 300 or img.width > 300:
-                output_size = (300, 300)
-                img.thumbnail(output_size)
-                img.save(self.image.path)
@@ -1,3 +1,4 @@
+from django.db import transaction
 from django.db.models.signals import post_save
 from django.contrib.auth.models import User
 from django.dispatch import receiver
@@ -13,3 +14,11 @@ def create_profile(sender, instance, created, **kwargs):
 @receiver(post_save, sender=User)
 def save_profile(sender, instance, **kwargs):
     instance.profile.save()
+
+
+@receiver(post_save, sender=Profile)
+def make_thumbnail(sender, instance, raw=False, **kwargs):
+    if not raw and getattr(instance, '_image_changed', False):
+        from chemmanager import jobs
+        name = instance.image.name
+        transaction.on_commit(lambda: jobs.enqueue('thumbnails', name=name, sizes=[Profile.THUMBNAIL_SIZE]))